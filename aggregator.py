@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from outbox import SEND_NORMAL
+
+log = logging.getLogger("chatbot")
+
+AGGREGATE_WINDOW = 2.0      # seconds to collect the same response before it's sent
+AGGREGATE_NAMES = 3         # names listed before the rest are summed up as "and N others"
+
+THANKS = "{line} Thanks {names}!"
+ADDRESSED = "{names}: {line}"
+
+def join_names(names, shown=AGGREGATE_NAMES):
+    '''
+    ["a", "b", "c", "d", "e"] -> "a, b, c and 2 others"
+    '''
+    if len(names) == 1:
+        return names[0]
+    if len(names) <= shown:
+        return f"{', '.join(names[:-1])} and {names[-1]}"
+    others = len(names) - shown
+    return f"{', '.join(names[:shown])} and {others} other{'s' if others != 1 else ''}"
+
+class PendingResponse:
+    __slots__ = ("line", "template", "priority", "users")
+
+    def __init__(self, line, template, priority):
+        self.line = line
+        self.template = template
+        self.priority = priority
+        self.users = {}     # used as an ordered set
+
+class ResponseAggregator:
+    '''
+    Collects the same response to many users over AGGREGATE_WINDOW seconds and sends it once.
+    A response that only one user got in the window is sent as is, otherwise the line is
+    sent once with the names worked in by its template, like "Squeak! Thanks a, b and 12 others!".
+
+    send is called as send(msg, priority=priority).
+    '''
+    def __init__(self, send, window=AGGREGATE_WINDOW):
+        self.send = send
+        self.window = window
+        self._pending = {}      # key -> PendingResponse
+
+    def add(self, key, user, line, template=THANKS, priority=SEND_NORMAL):
+        '''
+        Queue line for user. key says which responses are the same, e.g. ("headpat", "success").
+        The line of the first user in a window is the one that gets sent.
+        '''
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingResponse(line, template, priority)
+            asyncio.get_event_loop().call_later(self.window, self._flush, key)
+        pending.users[user] = None
+
+    def _flush(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        users = list(pending.users)
+        if len(users) == 1:
+            msg = pending.line
+        else:
+            msg = pending.template.format(line=pending.line, names=join_names(users))
+        try:
+            self.send(msg, priority=pending.priority)
+        except:
+            log.exception(f"Failed to send the response for {key}")
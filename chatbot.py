@@ -6,6 +6,7 @@ import irc.bot
 import irc.client
 import irc.client_aio
 import irc.strings
+import irc.modes
 import logging
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
@@ -13,7 +14,17 @@ from conf import *
 from commands import CommandHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.base import STATE_STOPPED, STATE_RUNNING, STATE_PAUSED
-from db import do_calc_happiness
+from db import do_calc_happiness, user_cache, enable_lazy_decay, init_storage, close_storage
+from storage import create_backend
+from usercache import CACHE_FLUSH_INTERVAL
+from points import POINTS_FLUSH_INTERVAL
+from ttlcache import TTLCache
+from message import MessageContext
+from twitchauth import TokenManager
+from helix import HelixClient, PRIORITY_HIGH, PRIORITY_NORMAL
+from streamstate import StreamStateService, parse_schedule
+from outbox import ChatOutbox, SEND_HIGH
+from workers import CommandPool
 
 sentry_logging = LoggingIntegration(
     level=logging.DEBUG, 
@@ -31,6 +42,20 @@ log.setLevel(logging.DEBUG)
 log.addHandler(epicfilehandler)
 log.addHandler(logging.StreamHandler(sys.stdout))
 
+store_log = logging.getLogger("storefront")
+storefilehandler = logging.FileHandler("store.log")
+storefilehandler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+store_log.setLevel(logging.DEBUG)
+store_log.addHandler(storefilehandler)
+
+# twitch lookups that rarely change are cached, misses are kept for a shorter time
+ID_CACHE_SIZE = 10000
+ID_CACHE_TTL = 24 * 60 * 60
+ID_NEGATIVE_TTL = 10 * 60
+MOD_CACHE_SIZE = 2000
+MOD_CACHE_TTL = 10 * 60
+MOD_NEGATIVE_TTL = 2 * 60
+
 class TheBot(irc.client_aio.AioSimpleIRCClient):
     def __init__(self):
         irc.client.SimpleIRCClient.__init__(self)
@@ -42,75 +67,81 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
         self.log = logging.getLogger("chatbot")         # Centralized logging
         
         # for twitch api stuff
-        self.auth_token = ""
         self.aio_session = None
+        self.user_ids = TTLCache(ID_CACHE_SIZE, ID_CACHE_TTL, ID_NEGATIVE_TTL)           # login -> user id, "" if there's no such user
+        self.mod_status = TTLCache(MOD_CACHE_SIZE, MOD_CACHE_TTL, MOD_NEGATIVE_TTL)     # (channel id, user id) -> is mod
         
         # shortcut to the async loop
         self.loop = self.connection.reactor.loop
         
+        # the token is added to each request, so the session can live as long as the bot
+        self.tokens = TokenManager(self.config.CLIENT_ID, self.config.CLIENT_SECRET, self.loop)
+        self.helix = HelixClient(self.tokens, self.loop)
+        # EventSub over a WebSocket only takes a user token, so push is only tried when one is configured
+        self.eventsub_tokens = None
+        if self.config.EVENTSUB_REFRESH_TOKEN:
+            self.eventsub_tokens = TokenManager(self.config.CLIENT_ID, self.config.CLIENT_SECRET, self.loop, refresh_token=self.config.EVENTSUB_REFRESH_TOKEN)
+
         # we have to get the aiosession in an async way because deprecated methods
+        # and then get the token on the startup
         self.loop.create_task(self.set_aio())
-        # and then refresh the token on the startup
-        self.loop.create_task(self.refresh_token())
 
-        # loop every once in a while to check if channel is live
-        self.loop.create_task(self.is_live_loop())
+        # live status is pushed to us when possible and polled when not, started once we have a token
         self.live = False
+        self.stream_state = StreamStateService(
+            self.helix, self.is_live, self.get_channel_id, self.on_live_change,
+            schedule=parse_schedule(self.config.STREAM_SCHEDULE),
+            ws_url=self.config.EVENTSUB_URL, subscriptions_url=self.config.EVENTSUB_SUBSCRIPTIONS_URL,
+            push_tokens=self.eventsub_tokens
+        )
+
+        # everything said in chat goes through here to stay under twitch's message limits
+        self.outbox = ChatOutbox(self.connection.privmsg)
+        self.loop.create_task(self.outbox.run())
+
+        # loop every once in a while to make sure we're still connected
+        self.loop.create_task(self.watchdog_loop())
+
+        # the users table lives wherever the config says, this has to happen before anything touches the db
+        init_storage(create_backend(self.config))
 
         # command handler stuff
         self.command_handler = CommandHandler(self, self.config.PREFIX)
+        self.command_pool = CommandPool()
+        self.loop.create_task(self.command_pool.run())
 
         # hydration reminder
         self.loop.create_task(self.remind_drink_water())
 
+        # decay rows as they're used instead of sweeping the whole table every night
+        if self.config.LAZY_DECAY:
+            enable_lazy_decay()
+
         # scheduler stuff
         self.scheduler = AsyncIOScheduler()
-        self.scheduler.add_job(do_calc_happiness, 'cron', hour='11', jitter=1800)
+        self.scheduler.add_job(do_calc_happiness, 'cron', hour='11', jitter=1800,
+                               kwargs={"chunk_size": self.config.DECAY_CHUNK_SIZE, "chunk_pause": self.config.DECAY_CHUNK_PAUSE})
         self.scheduler.add_job(self.reconnect_loop, 'interval', hours=3)
+        self.scheduler.add_job(user_cache.flush, 'interval', seconds=CACHE_FLUSH_INTERVAL)
+        self.scheduler.add_job(self.command_handler.points.flush, 'interval', seconds=POINTS_FLUSH_INTERVAL)
         self.scheduler.start()
         
     async def set_aio(self):
-        self.aio_session = aiohttp.ClientSession(headers={"Client-ID": self.config.CLIENT_ID, "Authorization": "Bearer %s" % self.auth_token, "User-Agent": "Brie/0.1 (+https://brie.everything.moe/)"})
-
-    async def validate_token(self):
-        '''
-        Just verify that the token we have right now is correct.
-        We have to use "OAuth" instead of "Bearer" and the reason why isn't very clear
-        '''
-        tmp_session = aiohttp.ClientSession(headers={"Client-ID": self.config.CLIENT_ID, "Authorization": f"OAuth {self.auth_token}"})
-        try:
-            left = 0
-            async with tmp_session.get("https://id.twitch.tv/oauth2/validate") as response:
-                output = await response.json()
-                left = int(output["expires_in"])
-            # dead sessions stay dead
-            await tmp_session.close()
-            return left > 0
-        except:
-            # Probably failed to validate.
-            log.exception(f"There was an exception while validating the Auth Token.")
-            return False
+        self.aio_session = aiohttp.ClientSession(headers={"Client-ID": self.config.CLIENT_ID, "User-Agent": "Brie/0.1 (+https://brie.everything.moe/)"})
+        self.tokens.session = self.aio_session
+        if self.eventsub_tokens is not None:
+            self.eventsub_tokens.session = self.aio_session
+        self.helix.session = self.aio_session
+        # started first so live tracking runs even if twitch can't give us a token yet, its polls retry the token
+        self.stream_state.start()
+        await self.tokens.keep_fresh()
 
-    async def refresh_token(self):
-        '''
-        Refresh the Bearer token for use in the Twitch API.
-        We don't need to specify scopes here at the moment since we aren't modifying anything or reading sensitive info.
-        '''
-        output = {}
-        async with self.aio_session.post(f"https://id.twitch.tv/oauth2/token?client_id={self.config.CLIENT_ID}&client_secret={self.config.CLIENT_SECRET}&grant_type=client_credentials") as response:
-            output = await response.json()
-            self.auth_token = output["access_token"]
-        # old sessions must die
-        try:
-            await self.aio_session.close()
-        except:
-            log.exception("A harmless exception occurred while closing the old ClientSession to refresh the Auth Token.")
-        await self.set_aio()
-        log.info(f"Refreshed Auth Token. Expire Time: {output['expires_in']}")
+    def on_live_change(self, live):
+        self.live = live
 
-    async def is_live_loop(self):
+    async def watchdog_loop(self):
         '''
-        Loop every 30 seconds and try to see if the defined channel is live.
+        Loop every 30 seconds and make sure the IRC connection is still up.
         '''
         while True:
             await asyncio.sleep(30)
@@ -121,19 +152,6 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
             if not self.connection.is_connected():
                 log.warning("Somehow, we lost the connection without knowing it.")
                 await self.connection.connect("irc.chat.twitch.tv", 6667, self.config.BOT_NAME, password=self.config.AUTH_ID)
-            if self.aio_session is None:
-                continue
-            if not await self.validate_token():
-                try:
-                    log.info("It appears the Auth Token failed to validate or is expired. Refreshing.")
-                    await self.refresh_token()
-                except:
-                    log.exception(f"An exception occurred while refreshing the Auth Token.")
-            try:
-                status = await self.is_live()
-                self.live = status
-            except:
-                log.exception(f"An exception occurred while updating the Live Status for {self.channel_id}")
 
     async def remind_drink_water(self):
         '''
@@ -144,7 +162,7 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
             await asyncio.sleep(45*60)
             try:
                 if self.live:
-                    self.connection.privmsg(self.target, msg)
+                    self.outbox.put(self.target, msg, SEND_HIGH)
             except:
                 log.exception("Failed to send hydration reminder in IRC chat")
 
@@ -162,6 +180,13 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
         else:
             print("Something is wrong and everything is broken (config is probably wrong)")
 
+    def on_userstate(self, connection, event):
+        '''
+        Event run when twitch tells us about ourselves in a channel, including whether we're a moderator there
+        '''
+        context = MessageContext(self.config.BOT_NAME, {d["key"]: d["value"] for d in event.tags or ()})
+        self.outbox.set_moderator(event.target, context.is_privileged)
+
     def on_join(self, connection, event):
         '''
         Event triggered by IRC JOIN Messages, which anyone can cause (starting with yourself)
@@ -169,6 +194,14 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
         # print("Someone joined the Twitch IRC Channel.")
         pass
 
+    def on_mode(self, connection, event):
+        '''
+        Event run when someone is modded or unmodded, which makes their cached mod status wrong
+        '''
+        for _, mode, login in irc.modes.parse_channel_modes(" ".join(event.arguments)):
+            if mode == "o" and login:
+                self.invalidate_user(user_name=login)
+
     def on_disconnect(self, connection, event):
         '''
         Event run on disconnecting from IRC
@@ -182,40 +215,23 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
         '''
         Event run for every message sent in the IRC Channel
         '''
-        name = event.source.nick.lower()
-        message = event.arguments[0].strip()
-        id = ""
+        # most of chat isn't for us, throw it away before doing any work on it
+        matched = self.command_handler.match(event.arguments[0].strip())
+        if matched is None:
+            return
 
-        for d in event.tags: # irc, why did you decide this format was good?
-            if d["key"] == "user-id":
-                id = d["value"]
+        context = MessageContext.from_event(event)
 
-        user = (name, id)
-        self.loop.create_task(
-            self.command_handler.parse_for_command(user, message)
-        )
+        # the tags are as good as an api answer, keep them for lookups by name
+        if context.user_id:
+            self.user_ids.set(context.user, context.user_id)
+            if context.has_tags and self.channel_id:
+                self.mod_status.set((self.channel_id, context.user_id), context.is_privileged)
 
-    async def wait_for_request_window(self, url):
-        '''
-        sometimes we can get rate limited. wait for the rate limit window by doing this.
-        also retry every 1 second on other errors (but only up to 30 times)
-        '''
-        attempt = True
-        output = {}
-        retries = 0
-        while attempt and retries < 30:
-            async with self.aio_session.get(url) as response:
-                output = await response.json()
-                if "status" in output:
-                    log.warning(f"Got status {output['status']} error while requesting on {url}.")
-                    if output["status"] == 429:
-                        await asyncio.sleep(15)
-                    else:
-                        await asyncio.sleep(1)
-                    retries += 1
-                else:
-                    attempt = False
-        return output
+        # host and mod commands from the host or a mod jump the queue
+        command, args = matched
+        self.command_pool.submit(context.user_id or context.user, self.command_handler.run_command, context, command, args,
+                                 priority=command.jumps_queue(context, self.config.HOST))
 
     async def get_channel_id_by_name(self, specific_login = None):
         '''
@@ -225,17 +241,34 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
         if specific_login is None:
             specific_login = self.channel_name
 
+        specific_login = specific_login.lower()
+        found, channel_id = self.user_ids.get(specific_login)
+        if found:
+            return channel_id
+
         url = f"https://api.twitch.tv/helix/users?login={specific_login}"
-        json_response = await self.wait_for_request_window(url)
+        json_response = await self.helix.get(url, PRIORITY_NORMAL)
         channel_id = ""
         try:
             channel_id = json_response["data"][0]["id"]
+            self.user_ids.set(specific_login, channel_id)
         except:
             # this would fail if data was empty (it usually isnt)
             print("Channel ID retrieval via login name failed.")
             log.warning(f"Channel ID retrieval for login {specific_login} failed.")
+            if json_response.get("data") == []:
+                # no such user, don't ask again for a while
+                self.user_ids.set(specific_login, "", negative=True)
         return channel_id
         
+    async def get_channel_id(self):
+        '''
+        The id of the channel we're in, looked up once.
+        '''
+        if self.channel_id == "":
+            self.channel_id = await self.get_channel_id_by_name()
+        return self.channel_id
+
     async def is_live(self, channel_id = None):
         '''
         Use new twitch api in a scuffed way to find out if a channel is live
@@ -250,7 +283,7 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
 
         # empty returns from the streams api endpoint mean the channel is offline
         url = f"https://api.twitch.tv/helix/streams?user_id={channel_id}"
-        json_response = await self.wait_for_request_window(url)
+        json_response = await self.helix.get(url, PRIORITY_HIGH)
         return len(json_response["data"]) != 0
 
     async def is_mod(self, user_name = None, channel_id = None, user_id = None):
@@ -266,17 +299,50 @@ class TheBot(irc.client_aio.AioSimpleIRCClient):
             channel_id = self.channel_id
         elif channel_id is None:
             channel_id = self.channel_id
+        if not user_id:
+            return False
+
+        found, status = self.mod_status.get((channel_id, user_id))
+        if found:
+            return status
 
         url = f"https://api.twitch.tv/kraken/users/{user_id}/chat/channels/{channel_id}?api_version=5"
         # the response on api v5, is simply { ... : ... } with lists or dicts optionally embedded
         # it seems to always exist as far as i can tell
-        json_response = await self.wait_for_request_window(url)
+        json_response = await self.helix.get(url, PRIORITY_NORMAL)
+        if "status" in json_response:
+            # ran out of retries, don't remember a guess
+            return False
 
         badges = json_response.get("badges", [])
-        for entry in badges:
-            if entry["id"] in ("moderator", "broadcaster"):
-                return True
-        return False
+        status = any(entry["id"] in ("moderator", "broadcaster") for entry in badges)
+        self.mod_status.set((channel_id, user_id), status, negative=not status)
+        return status
+
+    async def is_privileged(self, context):
+        '''
+        Mod or broadcaster check for whoever sent a message.
+        Read from the message tags, the api is only asked if the message came without them.
+        '''
+        if context.has_tags:
+            return context.is_privileged
+        return await self.is_mod(user_name=context.user, user_id=context.user_id or None)
+
+    def invalidate_user(self, user_name=None, user_id=None):
+        '''
+        Forget the cached id and mod status of a user.
+        Without a known user id every cached mod status is dropped, they're cheap to get back.
+        '''
+        if user_name is not None:
+            user_name = user_name.lower()
+            found, cached_id = self.user_ids.get(user_name)
+            self.user_ids.invalidate(user_name)
+            if user_id is None and found:
+                user_id = cached_id
+        if not user_id:
+            self.mod_status.clear()
+            return
+        self.mod_status.invalidate((self.channel_id, user_id))
 
     async def reconnect_loop(self):
         '''
@@ -297,10 +363,13 @@ def main():
     except SystemExit:
         for t in asyncio.Task.all_tasks():
             t.cancel()
+        # last chance for any unflushed game state to reach the database
+        bot.reactor.loop.run_until_complete(user_cache.flush())
         bot.reactor.loop.run_until_complete(bot.reactor.loop.shutdown_asyncgens())
         bot.reactor.loop.stop()
         log.info("Bot working to disconnect and close (initial stage).")
     finally:
+        close_storage()
         bot.connection.disconnect()
         bot.reactor.loop.close()
         log.info("Bot disconnected and closed (final stage).")
@@ -1,12 +1,16 @@
-import inspect
 import traceback
-import time
 import random
 import logging
-import json
 from streamElements import StreamElementsAPI
+from points import PointsLedger
+from outbox import SEND_NORMAL, SEND_LOW
+from aggregator import ResponseAggregator, ADDRESSED
+from registry import CommandRegistry, BUILTIN_COMMANDS, PRIVILEGE_MOD, PRIVILEGE_HOST, command
+from cooldowns import CooldownStore, CooldownPolicy
+from userids import UserIdSet
 from db import Database as db
-from db import BRIES_ID
+from db import user_cache, load_leaderboard
+from content import content
 from bonds import BondHandler, NoMoreAttemptsError, MissingItemError, BondFailedError
 from storefront import StoreHandler, NoItemError, NotEnoughSPError, AlreadyOwnedError, FreeFeedUsed, OutOfSeasonError
 
@@ -31,148 +35,132 @@ class CommandHandler:
         self.log = logging.getLogger("chatbot")
         self.parent = parent
         self.prefix = prefix
-        self.dialogue = {}
-
-        path = "dialogue.json"
-        try:
-            with open(path) as f:
-                self.dialogue = json.load(f)
-        except:
-            self.log.exception("Failed to load dialogue JSON.")
 
         # streamElements api implementation access
         self.se = StreamElementsAPI(parent.config.SE_ID, parent.config.JWT_ID, parent.loop)
+        # purchases spend against this, it pushes the changes to streamElements in the background
+        self.points = PointsLedger(self.se)
 
-        # command aliases. may be scrapped if not needed
-        self._aliases = {
-            "sd" : "shutdown"
-        }
+        # every command and alias, looked up once per message
+        # plugins can add their own with self.commands.register(name, coroutine, ...)
+        self.commands = CommandRegistry()
+        for name, attr, aliases, options in BUILTIN_COMMANDS:
+            self.commands.register(name, getattr(self, attr), aliases, **options)
 
         self.allow_online = False
 
-        # command cooldown dict
-        # keys are command names, values are dicts
-        #   keys of that dict are usernames, values are a timestamp
-        self.cooldowns = {f[4:] : {} for f in dir(self) if f[:4] == "cmd_"}
+        # bond replies to a crowd doing the same thing are sent once with everyone's names
+        self.responses = ResponseAggregator(self.send_message)
+
+        # (command name, user) -> when their cooldown ends, only running cooldowns are kept
+        self.cooldowns = CooldownStore()
+        self.cooldown_policy = CooldownPolicy.build(self.commands, BondHandler.bonds(), parent.config.COOLDOWNS)
+        # bond cooldowns come from bonds.json, so the policy is rebuilt whenever it's reloaded
+        content.on_swap(self.rebuild_cooldown_policy)
+        content.require_bonds(command.bond for command in self.commands if command.bond)
 
         # db cache for user accounts
-        # simply a set of all user ids
-        self.existing_users = set()
+        # every user id with a row, loaded once and then kept up to date as users are created
+        self.existing_users = UserIdSet()
         parent.loop.create_task(self.reload_existing_users())
 
-    # To check for mod powers:
-    # is_mod = await self.parent.is_mod(username)
+        # bond leaderboard is served from memory, build it once up front
+        parent.loop.create_task(load_leaderboard())
+
+    # To check for mod powers, take a context parameter:
+    # is_mod = await self.parent.is_privileged(context)
 
     # To check for live status:
     # is_live = await self.parent.is_live()
 
-    def send_message(self, msg, recipient=None):
+    def send_message(self, msg, recipient=None, priority=SEND_NORMAL):
         '''
         Simple wrapper to send a message.
         If a recipient is given, it needs to be in the format of a user name only. That will send a DM.
+        Messages are queued in the outbox so chat doesn't go over twitch's limits, use SEND_LOW for error replies.
         '''
         if msg == "" or msg is None:
             msg = "."
         if recipient is not None:
-            self.parent.connection.privmsg(recipient, msg)
+            self.parent.outbox.put(recipient, msg, priority)
         else:
-            self.parent.connection.privmsg(self.parent.target, msg)
+            self.parent.outbox.put(self.parent.target, msg, priority)
 
     async def reload_existing_users(self):
         '''
         Reset the cached list of users available.
         This is just to reduce the need for repeatedly pinging the db to see if a user exists.
         '''
-        result = await db.get_column("user_id")
-        for i in range(len(result)):
-            result[i] = str(result[i])
-        self.existing_users = set(result)
+        self.existing_users.replace(await db.get_column("user_id"))
 
-    async def parse_for_command(self, user_tuple, message):
+    def match(self, message):
         '''
-        Run a function defined within this class that matches the message
+        Cheap check, without touching the loop, for whether a chat message is a command we'd run right now.
+        Returns (command, args) or None.
         '''
         if not message.startswith(self.prefix):
-            return False
-
-        user = user_tuple[0]
-        user_id = user_tuple[1]
+            return None
+        parts = message[len(self.prefix):].split()
+        if not parts: # if it was only a prefix, fail
+            return None
+        command = self.commands.get(parts[0])
+        if command is None:
+            return None
+        # Check if the channel is online.
+        # We want this bot to deny all commands if the bot is online.
+        if self.parent.live and not self.allow_online and not command.allow_online:
+            return None
+        return command, parts[1:]
 
-        message = message[1:] # remove the prefix
-        if len(message) == 0: # if it was only a prefix, fail
+    async def parse_for_command(self, context, message):
+        '''
+        Run a function defined within this class that matches the message
+        context is the MessageContext of whoever sent it
+        '''
+        matched = self.match(message)
+        if matched is None:
             return False
+        return await self.run_command(context, *matched)
 
-        self.log.info(user + " ("+user_id+"): " + message)
+    async def run_command(self, context, command, args):
+        '''
+        Run a command that match() accepted.
+        '''
+        user = context.user
+        user_id = context.user_id
+        name = command.name
 
-        parts = message.split()
-        name = parts[0]
-        if name in self._aliases: # check if the word is an alias for a command
-            name = self._aliases[name]
+        self.log.info(f"{user} ({user_id}): {self.prefix}{name} {' '.join(args)}".rstrip())
 
-        # Trying to find the command function via the name determined above
-        command = getattr(self, f"cmd_{name}", None)
-        if command is None:
+        # Check for cooldown failure
+        cooldown_key = (name, user_id or user)
+        if self.cooldowns.remaining(cooldown_key):
+            self.log.info(f"{user} tried to execute command {name} but the cooldown hasn't ended.")
             return False
 
-        # Check if the channel is online.
-        # We want this bot to deny all commands if the bot is online.
-        if self.parent.live and not self.allow_online and name != "toggleonline":
-            self.log.info(f"{user} tried to execute command {name} but the channel is online.")
+        if not await self.has_privilege(command, context):
+            self.log.info(f"{user} attempted to execute command {name} but was denied.")
             return False
 
-        # Check for cooldown timestamp failure
-        # If the timestamp is in the past, success (if it's greater than now, fail)
-        now = time.time()
-        this_cooldown = self.cooldowns[name]
-        if user in this_cooldown:
-            if this_cooldown[user] > now:
-                self.log.info(f"{user} tried to execute command {name} but the cooldown hasn't ended.")
-                return False
-
         # Check to see that the user has info stored in the db for the game
-        # The first check is to the cache.
-        # If the check fails, update the list and check. If this fails, make a new entry.
+        # The check is to the cache. If the user isn't in it, make a new entry,
+        # which is a no-op on the db side if they turn out to have one already.
         if user_id not in self.existing_users:
-            await self.reload_existing_users()
-            if user_id not in self.existing_users:
-                self.log.info(f"Creating new user table entry for {user} ({user_id})")
-                await db.create_new_user(user_id, user)
-                self.existing_users.add(user_id)
-
-        parts.pop(0)
-        params = inspect.signature(command).parameters.copy()
-        kwargs = {}
-
-        # Parse mentions for the mention_list
-        # The final list is a list of user names without the @
-        mentions = []
-        for word in parts:
-            if word.startswith('@') and len(word) > 1:
-                mentions.append(word[1:])
-
-        # These are function parameters. Put the specific names as a param for it to be sent.
-        # user : user name
-        # uid : user ID
-        # args : rest of the message split into a list
-        # message : rest of the message as a string
-        # mention_list : list of user names mentioned by the message
-        if params.pop("user", None):
-            kwargs["user"] = user
-        if params.pop("uid", None):
-            kwargs["uid"] = user_id
-        if params.pop("args", None): # if blank, this is an empty list
-            kwargs["args"] = parts
-        if params.pop("message", None): # if blank, this is an empty string
-            kwargs["message"] = " ".join(parts)
-        if params.pop("mention_list", None): # if blank, message mentions nobody
-            kwargs["mention_list"] = mentions
+            if await db.create_new_user(user_id, user):
+                self.log.info(f"Created new user table entry for {user} ({user_id})")
+            self.existing_users.add(user_id)
+
+        # Only the values the command takes are worked out, see registry.INJECTORS
+        kwargs = command.kwargs(context, args)
 
         try:
-            result = await command(**kwargs)
+            result = await command.func(**kwargs)
             #
             # reach this point if we succeed, do whatever you want here
             # Any fully successful command will set a new cooldown.
-            this_cooldown[user] = now + 30.0
+            cooldown = self.cooldown_policy.seconds(name, context.role)
+            if cooldown > 0:
+                self.cooldowns.start(cooldown_key, cooldown)
             if result is None or result == True: # catch commands which dont return anything
                 self.log.info(f"{user} executed command {name} successfully.")
             elif result is not None and result != False:
@@ -196,38 +184,63 @@ class CommandHandler:
         finally:
             return True
 
-    def __choose_line(self, arr):
+    async def has_privilege(self, command, context):
+        '''
+        Check the sender against the privilege the command requires
+        '''
+        if command.privilege == PRIVILEGE_HOST:
+            return context.user == self.parent.host
+        if command.privilege == PRIVILEGE_MOD:
+            return await self.parent.is_privileged(context)
+        return True
+
+    def rebuild_cooldown_policy(self, current):
+        self.cooldown_policy = CooldownPolicy.build(self.commands, current.bonds, self.parent.config.COOLDOWNS)
+
+    @property
+    def dialogue(self):
+        '''
+        The current dialogue, reloaded by content.py when dialogue.json changes
+        '''
+        return content.current().dialogue
+
+    def __choose_line(self, lines):
         '''
-        Returns a random string from a list 
+        Returns a random string from a tuple
         of given strings
         '''
-        i = random.randint(0, len(arr)-1)
-        return arr[i]
+        return random.choice(lines)
 
-    async def cmd_shutdown(self, user):
+    @command(aliases=("sd",), privilege=PRIVILEGE_HOST)
+    async def cmd_shutdown(self):
         '''
         Close the bot. Host only.
         '''
-        if user == self.parent.host:
-            print("Saving and quitting IRC...")
-            await self.parent.aio_session.close()
-            await self.se.aio_session.close()
-            self.parent.connection.quit()
-            self.parent.scheduler.shutdown(wait=False)
-            return True
-        return False
+        print("Saving and quitting IRC...")
+        self.parent.tokens.close()
+        if self.parent.eventsub_tokens is not None:
+            self.parent.eventsub_tokens.close()
+        self.parent.stream_state.stop()
+        await self.parent.aio_session.close()
+        await self.points.flush()
+        await self.se.aio_session.close()
+        self.parent.connection.quit()
+        self.parent.scheduler.shutdown(wait=False)
+        # storage is closed by main() after the last flush, once every task has stopped
+        await user_cache.flush()
+        return True
 
-    async def cmd_toggleonline(self, user, uid):
+    @command(allow_online=True, privilege=PRIVILEGE_MOD)
+    async def cmd_toggleonline(self):
         '''
         Toggle the requirement for the bot to be online from chat.
         Mod only.
         '''
-        if await self.parent.is_mod(user_id=uid):
-            self.allow_online = not self.allow_online
-            self.send_message("Listening while streaming!" if self.allow_online else "No longer listening while streaming.")
-            return True
-        return False
+        self.allow_online = not self.allow_online
+        self.send_message("Listening while streaming!" if self.allow_online else "No longer listening while streaming.")
+        return True
 
+    @command()
     async def cmd_help(self, user, args):
         '''
         Direct Message a user the help guide.
@@ -236,26 +249,27 @@ class CommandHandler:
         self.send_message("Read how to play the game here! https://brie.everything.moe")
         return True
 
+    @command()
     async def cmd_stats(self, user, uid, args):
         '''
         Direct Message a user personal stats.
         '''
         # Left args in for specificity, if wanted
         
-        affection = await db.get_value(uid, "affection")
-        bond_level = await db.get_value(uid, "bond_level")
+        affection, bond_level = await db.get_values(uid, ["affection", "bond_level"])
         stat_str = f"{user}\'s stats with me are: {affection}% affection, {bond_level} bond level!"
 
         self.send_message(stat_str)
         return True
 
+    @command()
     async def cmd_topbonds(self, user, args):
         '''
         Display the bond leaderboard and happiness level.
         '''
         # Left args in for whatever reason
         
-        leaders = await db.get_top_rows_by_column_exclude_uid("username", "bond_level", 5, BRIES_ID)
+        leaders = await db.get_bond_leaders(5)
         brie_happiness = await db.get_brie_happiness()
         brie_hapLevel = brie_happiness//100 # floored integer
         if len(leaders) >= 3:
@@ -269,6 +283,18 @@ class CommandHandler:
         self.send_message(leaderboard_str)
         return True
 
+    @command()
+    async def cmd_rank(self, user, uid):
+        '''
+        Display a user's place on the bond leaderboard.
+        '''
+        rank = await db.get_bond_rank(uid)
+        if rank is None:
+            return False
+        self.send_message(f"{user} is #{rank[0]} out of {rank[1]} on my bond leaderboard!")
+        return True
+
+    @command()
     async def cmd_feed(self, user, uid, args):
         '''
         Feed a purchasable item. SP for the item is required. This helps hunger.
@@ -280,26 +306,27 @@ class CommandHandler:
         item = args[0].lower()
         # Check for SP requirement
         try:
-            user_sp = await self.se.get_user_points(user)
-            cost = await StoreHandler.try_feed(uid, user_sp, item)
-            await self.se.set_user_points(user, -cost)
-            self.send_message(self.__choose_line(self.dialogue["food"][item]))
+            async with self.points.reserve(user) as wallet:
+                cost = await StoreHandler.try_feed(uid, wallet.available, item)
+                wallet.debit(cost)
+            self.send_message(self.__choose_line(self.dialogue.food[item]))
         except NoItemError as e:
-            self.send_message(self.dialogue["info"]["cantbuyfood"])
+            self.send_message(self.dialogue.info["cantbuyfood"], priority=SEND_LOW)
             raise BrieError(e.message)
         except OutOfSeasonError as e:
-            self.send_message(self.dialogue["info"]["noseason"])
+            self.send_message(self.dialogue.info["noseason"], priority=SEND_LOW)
             raise BrieError(e.message)
         except NotEnoughSPError as e:
-            self.send_message(self.dialogue["info"]["nosp"])
+            self.send_message(self.dialogue.info["nosp"], priority=SEND_LOW)
             raise BrieError(e.message)
         except FreeFeedUsed as e:
-            self.send_message(self.dialogue["info"]["nofreefeed"])
+            self.send_message(self.dialogue.info["nofreefeed"], priority=SEND_LOW)
             raise BrieError(e.message)
         except:
             raise
         return True
 
+    @command()
     async def cmd_gift(self, user, uid, args):
         '''
         Gift a purchasable item. SP for the item is required. This gains affection.
@@ -311,20 +338,21 @@ class CommandHandler:
         item = args[0]
         # Check for SP requirement
         try:
-            user_sp = await self.se.get_user_points(user)
-            puzzle = await StoreHandler.try_gift(uid, user_sp, item)
-            await self.se.set_user_points(user, -puzzle["cost"])
-            self.send_message(self.dialogue["gifts"]["puzzle"][puzzle["reward"]])
+            async with self.points.reserve(user) as wallet:
+                puzzle = await StoreHandler.try_gift(uid, wallet.available, item)
+                wallet.debit(puzzle["cost"])
+            self.send_message(self.dialogue.gifts["puzzle"][puzzle["reward"]])
         except NoItemError as e:
-            self.send_message(self.dialogue["info"]["cantbuygift"])
+            self.send_message(self.dialogue.info["cantbuygift"], priority=SEND_LOW)
             raise BrieError(e.message)
         except NotEnoughSPError as e:
-            self.send_message(self.dialogue["info"]["nosp"])
+            self.send_message(self.dialogue.info["nosp"], priority=SEND_LOW)
             raise BrieError(e.message)
         except:
             raise
         return True
 
+    @command()
     async def cmd_buy(self, user, uid, args):
         '''
         Buy an item, associated with a specific bonding activity permanently.
@@ -336,18 +364,18 @@ class CommandHandler:
         item = args[0]
         # Check for SP
         try:
-            user_sp = await self.se.get_user_points(user)
-            cost = await StoreHandler.try_buy(uid, user_sp, item)
-            await self.se.set_user_points(user, -cost)
+            async with self.points.reserve(user) as wallet:
+                cost = await StoreHandler.try_buy(uid, wallet.available, item)
+                wallet.debit(cost)
             self.send_message(f"Squeak! (Here's your {item})!")
         except NoItemError as e:
-            self.send_message(self.dialogue["info"]["cantbuyitem"])
+            self.send_message(self.dialogue.info["cantbuyitem"], priority=SEND_LOW)
             raise BrieError(e.message)
         except NotEnoughSPError as e:
-            self.send_message(self.dialogue["info"]["nosp"])
+            self.send_message(self.dialogue.info["nosp"], priority=SEND_LOW)
             raise BrieError(e.message)
         except AlreadyOwnedError as e:
-            self.send_message(self.dialogue["info"]["alreadyown"])
+            self.send_message(self.dialogue.info["alreadyown"], priority=SEND_LOW)
             raise BrieError(e.message)
         except:
             raise
@@ -357,29 +385,34 @@ class CommandHandler:
         '''
         Private method to run the process of every bond command so code doesn't repeat over and over
         '''
-        bond = BondHandler.bond_list[bond_name]
+        # one snapshot for the whole attempt, so a reload can't pair this bond with other dialogue
+        current = content.current()
+        bond = current.bonds[bond_name]
+        dialogue = current.dialogue
         try:
             await BondHandler.try_bond(uid, bond)
-            self.send_message(self.__choose_line(self.dialogue["bonding"][bond_name]["success"]))
+            self.responses.add((bond_name, "success"), user, self.__choose_line(dialogue.bond_success[bond_name]))
             return True
         except NoMoreAttemptsError:
-            self.send_message(self.dialogue["info"]["noattempts"])
+            self.responses.add("noattempts", user, dialogue.info["noattempts"], ADDRESSED, SEND_LOW)
             raise BrieError("Out of bond attempts.")
         except MissingItemError as e:
-            self.send_message(self.dialogue["info"][f"no{bond['item']}"])
+            self.responses.add(f"no{bond.item}", user, dialogue.info[f"no{bond.item}"], ADDRESSED, SEND_LOW)
             raise BrieError(e.message)
         except BondFailedError:
-            self.send_message(self.__choose_line(self.dialogue["bonding"][bond_name]["failure"]))
+            self.responses.add((bond_name, "failure"), user, self.__choose_line(dialogue.bond_failure[bond_name]), ADDRESSED)
             return "Bond failed."
         except:
             raise
 
+    @command(bond="headpat")
     async def cmd_headpat(self, user, uid):
         '''
         Head pat bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "headpat")
 
+    @command(bond="scratch")
     async def cmd_scratch(self, user, uid):
         '''
         Scratch bonding activity
@@ -387,12 +420,14 @@ class CommandHandler:
         '''
         return await self.__bond_command_internal(user, uid, "scratch")
 
+    @command(bond="hug")
     async def cmd_hug(self, user, uid):
         '''
         Hug bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "hug")
 
+    @command(bond="tickle")
     async def cmd_tickle(self, user, uid):
         '''
         Tickle bonding activity
@@ -400,12 +435,14 @@ class CommandHandler:
         '''
         return await self.__bond_command_internal(user, uid, "tickle")
 
+    @command(bond="nuzzle")
     async def cmd_nuzzle(self, user, uid):
         '''
         Nuzzle bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "nuzzle")
 
+    @command(bond="brush")
     async def cmd_brush(self, user, uid):
         '''
         Brush bonding activity
@@ -413,24 +450,28 @@ class CommandHandler:
         '''
         return await self.__bond_command_internal(user, uid, "brush")
 
+    @command(bond="massage")
     async def cmd_massage(self, user, uid):
         '''
         Massage bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "massage")
 
+    @command(bond="bellyrub")
     async def cmd_bellyrub(self, user, uid):
         '''
         Belly rub bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "bellyrub")
 
+    @command(bond="cuddle")
     async def cmd_cuddle(self, user, uid):
         '''
         Cuddling bonding activity
         '''
         return await self.__bond_command_internal(user, uid, "cuddle")
 
+    @command(bond="holdhands")
     async def cmd_holdhands(self, user, uid):
         '''
         Hand holding bonding activity
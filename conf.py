@@ -30,14 +30,38 @@ class Conf:
         self.CLIENT_ID = config.get("Password", "Client ID", fallback=Fallbacks.CLIENT_ID)
         self.CLIENT_SECRET = config.get("Password", "Client Secret", fallback=Fallbacks.CLIENT_SECRET)
         self.SE_ID = config.get("Password", "SE_ID", fallback=Fallbacks.SE_ID)
+        self.EVENTSUB_REFRESH_TOKEN = config.get("Password", "EventSub Refresh Token", fallback=Fallbacks.EVENTSUB_REFRESH_TOKEN)
 
         self.BOT_NAME = config.get("Names", "Bot Nickname", fallback=Fallbacks.BOT_NAME)
         self.HOST = config.get("Names", "Host", fallback=Fallbacks.HOST).lower()
 
         self.CHANNEL_NAME = config.get("Channel", "Name", fallback=Fallbacks.CHANNEL_NAME)
+        self.STREAM_SCHEDULE = config.get("Channel", "Usual Start Times", fallback=Fallbacks.STREAM_SCHEDULE)
+        self.EVENTSUB_URL = config.get("Channel", "EventSub URL", fallback=Fallbacks.EVENTSUB_URL)
+        self.EVENTSUB_SUBSCRIPTIONS_URL = config.get("Channel", "EventSub Subscriptions URL", fallback=Fallbacks.EVENTSUB_SUBSCRIPTIONS_URL)
         
         self.PREFIX = config.get("Commands", "Prefix", fallback=Fallbacks.PREFIX)
 
+        # command or command.role -> seconds, see cooldowns.py
+        self.COOLDOWNS = {}
+        if config.has_section("Cooldowns"):
+            for key in config.options("Cooldowns"):
+                try:
+                    self.COOLDOWNS[key] = config.getfloat("Cooldowns", key)
+                except ValueError:
+                    print(f"Ignoring cooldown {key}, it needs to be a number of seconds.")
+
+        self.DECAY_CHUNK_SIZE = config.getint("Jobs", "Decay Chunk Size", fallback=Fallbacks.DECAY_CHUNK_SIZE)
+        self.DECAY_CHUNK_PAUSE = config.getfloat("Jobs", "Decay Chunk Pause", fallback=Fallbacks.DECAY_CHUNK_PAUSE)
+        self.LAZY_DECAY = config.getboolean("Jobs", "Lazy Decay", fallback=Fallbacks.LAZY_DECAY)
+
+        self.DB_BACKEND = config.get("Database", "Backend", fallback=Fallbacks.DB_BACKEND).lower()
+        self.DB_HOST = config.get("Database", "Host", fallback=Fallbacks.DB_HOST)
+        self.DB_USER = config.get("Database", "User", fallback=Fallbacks.DB_USER)
+        self.DB_PASSWORD = config.get("Database", "Password", fallback=Fallbacks.DB_PASSWORD)
+        self.DB_NAME = config.get("Database", "Name", fallback=Fallbacks.DB_NAME)
+        self.DB_SQLITE_PATH = config.get("Database", "SQLite Path", fallback=Fallbacks.DB_SQLITE_PATH)
+
 
 
 class Fallbacks:  # these will only get used if the user leaves the config.ini existant but really messes something up... everything breaks if they get used.
@@ -48,5 +72,18 @@ class Fallbacks:  # these will only get used if the user leaves the config.ini e
     CLIENT_ID = "got oofed"
     CLIENT_SECRET = "b"
     CHANNEL_NAME = "shroud"
+    STREAM_SCHEDULE = ""
+    EVENTSUB_REFRESH_TOKEN = ""
+    EVENTSUB_URL = "wss://eventsub.wss.twitch.tv/ws"
+    EVENTSUB_SUBSCRIPTIONS_URL = "https://api.twitch.tv/helix/eventsub/subscriptions"
     HOST = "0fallback"
     PREFIX = "!"
+    DECAY_CHUNK_SIZE = 500
+    DECAY_CHUNK_PAUSE = 0.1
+    LAZY_DECAY = False
+    DB_BACKEND = "mariadb"
+    DB_HOST = "localhost"
+    DB_USER = "brie"
+    DB_PASSWORD = "3th3rn3t"
+    DB_NAME = "Brie"
+    DB_SQLITE_PATH = "brie.sqlite3"
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import random
+import time
+
+log = logging.getLogger("chatbot")
+
+CONTENT_CHECK_INTERVAL = 5      # seconds between looks at the content files' modified times
+MAX_AFFECTION = 100             # affection is capped here, so the success curve only needs this many points
+
+# Lines from the "info" section the commands use, every bond's missing item line is required as well
+INFO_LINES = ("noseason", "nofreefeed", "nosp", "cantbuyitem", "cantbuyfood", "alreadyown", "cantbuygift", "noattempts")
+GIFT_REWARDS = ("common", "uncommon", "rare")
+
+class ContentError(Exception):
+    def __init__(self, path, problem):
+        self.message = f"{path}: {problem}"
+
+def success_chance(gate_affection, given_affection, scale_min, scale_max):
+    '''
+    Percent chance a bond succeeds, see Bond.roll.
+    '''
+    return min(1, (given_affection / gate_affection)) * (scale_max - scale_min) + scale_min
+
+class Bond:
+    '''
+    One entry of bonds.json.
+    chances[affection] is the percent chance of success at each affection from 0 to MAX_AFFECTION,
+    already zero below min_aff, so a roll is one lookup and one random number.
+    '''
+    __slots__ = ("name", "worth", "item", "gate_aff", "scale_min", "scale_max", "min_aff", "cooldown", "chances")
+
+    def __init__(self, name, worth, item, gate_aff, scale_min, scale_max, min_aff=None, cooldown=None):
+        self.name = name
+        self.worth = worth
+        self.item = item.lower()
+        self.gate_aff = gate_aff
+        self.scale_min = scale_min
+        self.scale_max = scale_max
+        self.min_aff = min_aff
+        self.cooldown = cooldown
+        self.chances = tuple(self.chance(affection) for affection in range(MAX_AFFECTION + 1))
+
+    def chance(self, affection):
+        if self.min_aff is not None and affection < self.min_aff:
+            return 0
+        return success_chance(self.gate_aff, affection, self.scale_min, self.scale_max)
+
+    def roll(self, affection):
+        '''
+        Returns whether a bond attempt at this affection succeeds, by random chance.
+        '''
+        if 0 <= affection <= MAX_AFFECTION:
+            chance = self.chances[affection]
+        else:
+            chance = self.chance(affection)
+        return chance >= random.randint(1, 100)
+
+class Dialogue:
+    '''
+    dialogue.json with every pool of lines as a tuple.
+    '''
+    __slots__ = ("food", "info", "gifts", "bond_success", "bond_failure")
+
+    def __init__(self, food, info, gifts, bond_success, bond_failure):
+        self.food = food                    # food -> lines
+        self.info = info                    # info key -> line
+        self.gifts = gifts                  # gift -> {reward type: line}
+        self.bond_success = bond_success    # bond -> lines
+        self.bond_failure = bond_failure    # bond -> lines
+
+class Content:
+    '''
+    One consistent set of bonds and dialogue. The bonds and dialogue aren't changed once built, a reload makes a new Content.
+    '''
+    __slots__ = ("bonds", "dialogue")
+
+    def __init__(self, bonds, dialogue):
+        self.bonds = bonds
+        self.dialogue = dialogue
+
+def _require(condition, path, problem):
+    if not condition:
+        raise ContentError(path, problem)
+
+def _number(value, path, field, minimum=None, maximum=None):
+    _require(isinstance(value, (int, float)) and not isinstance(value, bool), path, f"{field} has to be a number")
+    _require(minimum is None or value >= minimum, path, f"{field} can't be below {minimum}")
+    _require(maximum is None or value <= maximum, path, f"{field} can't be above {maximum}")
+    return value
+
+def _lines(value, path, field):
+    _require(isinstance(value, list) and value, path, f"{field} has to be a list with at least one line")
+    for line in value:
+        _require(isinstance(line, str) and line, path, f"{field} can only hold non-empty strings")
+    return tuple(value)
+
+def _line(value, path, field):
+    _require(isinstance(value, str) and value, path, f"{field} has to be a non-empty string")
+    return value
+
+def compile_bonds(data, path="bonds.json"):
+    _require(isinstance(data, dict) and data, path, "has to be an object of bonds")
+    bonds = {}
+    for name, entry in data.items():
+        where = f"{name}"
+        _require(isinstance(entry, dict), path, f"{where} has to be an object")
+        _require(isinstance(entry.get("item"), str), path, f"{where}.item has to be a string, empty for no item")
+        worth = _number(entry.get("worth"), path, f"{where}.worth", minimum=0)
+        _require(isinstance(worth, int), path, f"{where}.worth has to be a whole number")
+        gate_aff = _number(entry.get("gate_aff"), path, f"{where}.gate_aff", minimum=1)
+        scale_min = _number(entry.get("scale_min"), path, f"{where}.scale_min", 0, 100)
+        scale_max = _number(entry.get("scale_max"), path, f"{where}.scale_max", scale_min, 100)
+        min_aff = entry.get("min_aff")
+        if min_aff is not None:
+            _number(min_aff, path, f"{where}.min_aff", 0)
+        cooldown = entry.get("cooldown")
+        if isinstance(cooldown, dict):
+            for role, seconds in cooldown.items():
+                _number(seconds, path, f"{where}.cooldown.{role}", 0)
+        elif cooldown is not None:
+            _number(cooldown, path, f"{where}.cooldown", 0)
+        bonds[name] = Bond(name, worth, entry["item"], gate_aff, scale_min, scale_max, min_aff, cooldown)
+    return bonds
+
+def compile_dialogue(data, bonds, path="dialogue.json"):
+    _require(isinstance(data, dict), path, "has to be an object")
+    for section in ("food", "info", "gifts", "bonding"):
+        _require(isinstance(data.get(section), dict), path, f"{section} has to be an object")
+
+    food = {name: _lines(lines, path, f"food.{name}") for name, lines in data["food"].items()}
+    info = {key: _line(line, path, f"info.{key}") for key, line in data["info"].items()}
+    required = set(INFO_LINES)
+    required.update(f"no{bond.item}" for bond in bonds.values() if bond.item)
+    for key in sorted(required):
+        _require(key in info, path, f"info.{key} is missing")
+
+    gifts = {}
+    for name, rewards in data["gifts"].items():
+        _require(isinstance(rewards, dict), path, f"gifts.{name} has to be an object")
+        gifts[name] = {reward: _line(rewards.get(reward), path, f"gifts.{name}.{reward}") for reward in GIFT_REWARDS}
+
+    bond_success = {}
+    bond_failure = {}
+    for name in bonds:
+        # every bond needs something to say, or the command would fail after the attempt was spent
+        lines = data["bonding"].get(name)
+        _require(isinstance(lines, dict), path, f"bonding.{name} is missing for the bond in bonds.json")
+        bond_success[name] = _lines(lines.get("success"), path, f"bonding.{name}.success")
+        bond_failure[name] = _lines(lines.get("failure"), path, f"bonding.{name}.failure")
+
+    return Dialogue(food, info, gifts, bond_success, bond_failure)
+
+class ContentRegistry:
+    '''
+    The live bonds and dialogue. Both files are validated and compiled together and swapped in
+    with one assignment, so a command sees either the old content or the new, never a mix.
+    An edit that doesn't validate, or drops a bond a command needs, is logged and the old content stays live.
+    Anything built from the content, like the cooldown policy, can ask to be told about swaps with on_swap.
+    '''
+    def __init__(self, bonds_path="bonds.json", dialogue_path="dialogue.json"):
+        self.bonds_path = bonds_path
+        self.dialogue_path = dialogue_path
+        self.content = Content({}, Dialogue({}, {}, {}, {}, {}))
+        self.next_check = 0.0
+        self.mtimes = None              # modified times of the files the last reload read, whether or not they were swapped in
+        self.required_bonds = set()     # bonds registered commands use
+        self.listeners = []             # called with the new Content after every swap
+
+    def require_bonds(self, names):
+        '''
+        Bonds that have to stay in bonds.json, reloads without them are rejected.
+        '''
+        self.required_bonds.update(names)
+        for name in sorted(self.required_bonds - self.content.bonds.keys()):
+            log.error(f"{self.bonds_path}: {name} is missing but a command uses it.")
+
+    def on_swap(self, callback):
+        self.listeners.append(callback)
+
+    def _mtimes(self):
+        try:
+            return (os.stat(self.bonds_path).st_mtime, os.stat(self.dialogue_path).st_mtime)
+        except OSError:
+            return None
+
+    def build(self):
+        '''
+        Read, validate and compile both files. Raises ContentError if anything is wrong.
+        '''
+        data = []
+        for path in (self.bonds_path, self.dialogue_path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data.append(json.load(f))
+            except (OSError, ValueError) as e:
+                raise ContentError(path, e)
+        bonds = compile_bonds(data[0], self.bonds_path)
+        for name in sorted(self.required_bonds - bonds.keys()):
+            raise ContentError(self.bonds_path, f"{name} is missing but a command uses it")
+        dialogue = compile_dialogue(data[1], bonds, self.dialogue_path)
+        return Content(bonds, dialogue)
+
+    def reload(self):
+        '''
+        Returns True if the new content was swapped in.
+        '''
+        # taken first, so an edit made while reading is picked up by the next check
+        self.mtimes = self._mtimes()
+        try:
+            content = self.build()
+        except ContentError as e:
+            log.error(f"Rejected game content, keeping what was loaded before. {e.message}")
+            return False
+        self.content = content
+        log.info(f"Loaded {len(content.bonds)} bonds and their dialogue.")
+        for callback in self.listeners:
+            try:
+                callback(content)
+            except:
+                log.exception("Content swap hook failed.")
+        return True
+
+    def current(self):
+        '''
+        The content to use right now. Every CONTENT_CHECK_INTERVAL seconds the files are checked and reloaded if they changed.
+        '''
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + CONTENT_CHECK_INTERVAL
+            mtimes = self._mtimes()
+            # broken files aren't retried every few seconds, only once they change again
+            if mtimes is not None and mtimes != self.mtimes:
+                self.reload()
+        return self.content
+
+# The one registry the bot uses
+content = ContentRegistry()
+content.reload()
@@ -0,0 +1,87 @@
+import heapq
+import time
+
+DEFAULT_COOLDOWN = 30.0         # seconds before a user can run the same command again
+COOLDOWN_RECLAIM_BATCH = 64     # expired entries cleaned up per call, so no call pays for a big cleanup
+
+# Roles a cooldown can be set for, see MessageContext.role
+ROLES = ("mod", "subscriber", "viewer")
+
+class CooldownStore:
+    '''
+    Cooldowns keyed by anything hashable, usually (command, user).
+    Checks are a dict lookup. Expiry times are also kept in a heap so entries that have run out
+    are removed a few at a time on every call, and the store only ever holds live cooldowns.
+    '''
+    def __init__(self):
+        self._until = {}        # key -> time.monotonic() the cooldown ends
+        self._expiry = []       # heap of (ends, key), may hold stale entries for keys that were restarted
+
+    def remaining(self, key, now=None):
+        '''
+        Seconds left on a cooldown, 0 if there is none.
+        '''
+        now = time.monotonic() if now is None else now
+        self._reclaim(now)
+        until = self._until.get(key)
+        if until is None or until <= now:
+            return 0
+        return until - now
+
+    def start(self, key, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        self._reclaim(now)
+        until = now + seconds
+        self._until[key] = until
+        heapq.heappush(self._expiry, (until, key))
+
+    def _reclaim(self, now, budget=COOLDOWN_RECLAIM_BATCH):
+        expiry = self._expiry
+        while expiry and budget and expiry[0][0] <= now:
+            until, key = heapq.heappop(expiry)
+            if self._until.get(key) == until:
+                del self._until[key]
+            budget -= 1
+
+    def __len__(self):
+        return len(self._until)
+
+class CooldownPolicy:
+    '''
+    How long each command's cooldown is for each role.
+    table maps "command.role", "command", "default.role" and "default" to seconds, the most specific one wins.
+    '''
+    def __init__(self, table):
+        self.table = {"default": DEFAULT_COOLDOWN}
+        self.table.update(table)
+        self._resolved = {}
+
+    def seconds(self, name, role):
+        key = (name, role)
+        seconds = self._resolved.get(key)
+        if seconds is None:
+            for candidate in (f"{name}.{role}", name, f"default.{role}", "default"):
+                if candidate in self.table:
+                    seconds = self._resolved[key] = self.table[candidate]
+                    break
+        return seconds
+
+    @staticmethod
+    def build(commands, bonds, config):
+        '''
+        Put the table together from, in increasing order of say: the cooldown a command was registered with,
+        "cooldown" in its bonds.json entry (bonds maps names to content.Bond), and the [Cooldowns] section of the config.
+        '''
+        table = {}
+        for command in commands:
+            if command.cooldown is not None:
+                table[command.name] = command.cooldown
+        for name, bond in bonds.items():
+            cooldown = bond.cooldown
+            if isinstance(cooldown, dict):
+                for role, seconds in cooldown.items():
+                    table[name if role == "default" else f"{name}.{role}"] = float(seconds)
+            elif cooldown is not None:
+                table[name] = float(cooldown)
+        table.update(config)
+        return CooldownPolicy(table)
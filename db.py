@@ -1,44 +1,87 @@
+import asyncio
 import logging
-import MySQLdb as mariadb
 import time
 import datetime as dt
+from storage import STORAGE_ERRORS
+from usercache import UserCache, USER_COLUMNS, COMPARISONS
+from leaderboard import Leaderboard
+import decay
 
 log = logging.getLogger("chatbot")
 
 BRIES_ID = "436478155"
 
-def connect():
-    try:
-        # Should probably move the credentials to a config
-        mariadb_connection = mariadb.connect(host="localhost", user='brie', password='3th3rn3t', db='Brie', autocommit=True)
-        return mariadb_connection
-    except mariadb.Error as error:
-        log.error(f"Failed to connect to the MariaDB server: {error}")
-        raise
-
-connection = connect()
-
-def query(sql):
-    global connection
-    try:
-      cursor = connection.cursor()
-      cursor.execute(sql)
-    except (AttributeError, mariadb.OperationalError):
-      connection = connect()
-      cursor = connection.cursor()
-      cursor.execute(sql)
-    return cursor
-
-async def dict_query(sql):
-    global connection
-    try:
-      dict_cursor = connection.cursor(mariadb.cursors.DictCursor)
-      dict_cursor.execute(sql)
-    except (AttributeError, mariadb.OperationalError):
-      connection = connect()
-      dict_cursor = connection.cursor(mariadb.cursors.DictCursor)
-      dict_cursor.execute(sql)
-    return dict_cursor
+# Nightly decay tuning, overridden by the [Jobs] section of the config
+DECAY_CHUNK_SIZE = 500          # users updated per statement
+DECAY_CHUNK_PAUSE = 0.1         # seconds to sleep between chunks so chat traffic gets the table back
+
+# When set, rows are decayed when they are next used instead of by the nightly sweep. See enable_lazy_decay().
+lazy_decay = False
+
+# The storage backend holding the users table, see storage.py. Set by init_storage().
+storage = None
+
+def init_storage(backend):
+    '''
+    Open the storage backend and read the users table layout.
+    Has to be called once before anything else in here is used.
+    '''
+    global storage
+    fields = backend.open()
+    storage = backend
+    Database.set_table_fields(fields)
+    log.info(f"Opened {type(backend).__name__} storage.")
+
+def close_storage():
+    if storage is not None:
+        storage.close()
+
+async def _load_user_row(user_id):
+    return await storage.load_user(user_id)
+
+async def _write_user_rows(batch):
+    await storage.write_users(batch)
+
+# Bond ranking served from memory. Kept current by the cache hook below and rebuilt after decay.
+leaderboard = Leaderboard(exclude=(BRIES_ID,))
+
+def _on_user_change(user_id, record, fields):
+    if "bond_level" in fields:
+        leaderboard.update(user_id, record.bond_level, record.username)
+
+async def load_leaderboard():
+    '''
+    (Re)build the in-memory leaderboard from the users table.
+    With lazy decay the bond levels are read as they would be once caught up to today.
+    '''
+    leaderboard.load(await storage.get_leaderboard_rows(lazy_decay))
+
+def _prepare_row(user_id, record):
+    if user_id == BRIES_ID:
+        return ()
+    return decay.catch_up(record, dt.date.today())
+
+async def _catch_up_decay(user_id):
+    '''
+    Bring one row up to date before it is read or written directly through SQL.
+    Rows that are already current don't match, so this is a no-op most of the time.
+    '''
+    if not lazy_decay or user_id == BRIES_ID:
+        return
+    await storage.catch_up_decay(user_id)
+
+def enable_lazy_decay():
+    '''
+    Switch from the nightly decay sweep to decaying each row the next time it is read or written.
+    The nightly job then only recalculates happiness and the leaderboard, using the same rules on the fly.
+    '''
+    global lazy_decay
+    lazy_decay = True
+    user_cache.prepare = _prepare_row
+    log.info("Lazy decay enabled.")
+
+# Write-behind cache for per-user reads and writes. Flushed on a schedule by the bot.
+user_cache = UserCache(_load_user_row, _write_user_rows, on_change=_on_user_change)
 
 class DatabaseException(Exception):
     def __init__(self, message="This is a generic database error."):
@@ -67,50 +110,29 @@ class Database():
         else:
             raise InvaludUserIdTypeException(user_id=user_id, reason="Non-string type.")
 
-    def __get_table_fields(table):
-
-        __sql = f"SHOW COLUMNS FROM {table}"
-        fields = []
-        try:
-            cursor = query(__sql)
-            res = cursor.fetchall()
-            for field in res:
-                fields.append(field[0])
-            return fields
-        except mariadb.Error as error:
-            log.error(f"Failed to get table columns: {error}")
-            raise
+    # Filled in by init_storage()
+    __user_table_fields = []
 
-    __user_table_fields = __get_table_fields("users")
+    @staticmethod
+    def set_table_fields(fields):
+        Database.__user_table_fields = list(fields)
 
     @staticmethod
     async def create_new_user(user_id, username):
         '''
         Creates new user entry with default values from config.
+        Does nothing if the user already has one. Returns True if the entry was created.
         '''
-
-        global connection
         try:
             Database.user_id_check(user_id)
             now = time.time()
             now = dt.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
 
-            # By not updating last_fed_brie_timestamp it inherits the default value defined by the table schema.
-            try:
-                cursor = connection.cursor()
-                cursor.execute(
-                    "INSERT INTO users (username,user_id,affection,bond_level,bonds_available,has_feather,has_brush,has_scratcher,free_feed,created_at,updated_at) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", 
-                    (username,user_id,0,0,0,0,0,0,0,now,now)
-                )
-            except (AttributeError, mariadb.OperationalError):
-                connection = connect()
-                cursor = connection.cursor()
-                cursor.execute(
-                    "INSERT INTO users (username,user_id,affection,bond_level,bonds_available,has_feather,has_brush,has_scratcher,free_feed,created_at,updated_at) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", 
-                    (username,user_id,0,0,0,0,0,0,0,now,now)
-                )
-            return cursor
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            created = await storage.create_user(user_id, username, now)
+            if created:
+                leaderboard.update(user_id, 0, username)
+            return created
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to create new user: {error}")
             raise
 
@@ -118,12 +140,14 @@ class Database():
     async def set_value(index, val_name, val):
         if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
 
-        __sql = f"UPDATE users SET {val_name} = {val} WHERE user_id = {index}"
-
         try:
             Database.user_id_check(index)
-            cursor = query(__sql)
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            if val_name in USER_COLUMNS:
+                await user_cache.set_value(index, val_name, val)
+            else:
+                await _catch_up_decay(index)
+                await storage.update_user(index, {}, {val_name: val}, {}, {})
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to set {val_name} to {val} for user_id: {index} \n {error}")
             raise
 
@@ -131,12 +155,14 @@ class Database():
     async def add_value(index, val_name, val):
         if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
 
-        __sql = f"UPDATE users SET {val_name} = {val_name} + {val} WHERE user_id = {index}"
-
         try:
             Database.user_id_check(index)
-            cursor = query(__sql)
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            if val_name in USER_COLUMNS:
+                await user_cache.add_value(index, val_name, val)
+            else:
+                await _catch_up_decay(index)
+                await storage.update_user(index, {val_name: val}, {}, {}, {})
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to set {val_name} to {val} for user_id: {index} \n {error}")
             raise
 
@@ -144,12 +170,14 @@ class Database():
     async def remove_value(index, val_name, val):
         if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
 
-        __sql = f"UPDATE users SET {val_name} = {val_name} - {val} WHERE user_id = {index}"
-
         try:
             Database.user_id_check(index)
-            cursor = query(__sql)
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            if val_name in USER_COLUMNS:
+                await user_cache.add_value(index, val_name, -val)
+            else:
+                await _catch_up_decay(index)
+                await storage.update_user(index, {val_name: -val}, {}, {}, {})
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to set {val_name} to {val} for user_id: {index} \n {error}")
             raise
 
@@ -157,29 +185,90 @@ class Database():
     async def get_value(index, val_name):
         if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
 
-        __sql = f"SELECT {val_name} FROM users WHERE user_id = {index}"
-
         try:
             Database.user_id_check(index)
-            cursor = query(__sql)
-            res = cursor.fetchall()
-            return res[0][0]
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            if val_name in USER_COLUMNS:
+                found, value = await user_cache.get_value(index, val_name)
+                if not found:
+                    raise DatabaseException(f"No users entry for user_id: {index}")
+                return value
+            await _catch_up_decay(index)
+            values = await storage.get_values(index, [val_name])
+            if values is None:
+                raise DatabaseException(f"No users entry for user_id: {index}")
+            return values[0]
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to get {val_name} for user_id: {index} \n {error}")
             raise
 
+    @staticmethod
+    async def get_values(index, val_names):
+        '''
+        Returns a tuple of several columns of a user's row with a single lookup.
+        '''
+        for val_name in val_names:
+            if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
+
+        try:
+            Database.user_id_check(index)
+            if all(val_name in USER_COLUMNS for val_name in val_names):
+                values = await user_cache.get_values(index, val_names)
+                if values is None:
+                    raise DatabaseException(f"No users entry for user_id: {index}")
+                return values
+            await _catch_up_decay(index)
+            values = await storage.get_values(index, val_names)
+            if values is None:
+                raise DatabaseException(f"No users entry for user_id: {index}")
+            return values
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
+            log.error(f"Failed to get {val_names} for user_id: {index} \n {error}")
+            raise
+
+    @staticmethod
+    async def apply_deltas(index, deltas, sets=None, caps=None, where=None):
+        '''
+        Apply several changes to a user's row at once, as a single statement.
+        deltas maps column names to amounts to add (negative to subtract),
+        sets maps column names to values to assign,
+        caps maps delta columns to the highest value they may reach,
+        where maps column names to (op, value) conditions the row has to meet, e.g. {"bonds_available": (">", 0)}.
+        Returns True if the row was updated, False if it doesn't exist or a condition failed.
+        '''
+        if sets is None:
+            sets = {}
+        if caps is None:
+            caps = {}
+        if where is None:
+            where = {}
+        columns = list(deltas) + list(sets) + list(caps) + list(where)
+        for val_name in columns:
+            if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
+        for op, _ in where.values():
+            if op not in COMPARISONS: raise DatabaseException(f"{op} is not a supported comparison.")
+        if not deltas and not sets:
+            return True
+
+        try:
+            Database.user_id_check(index)
+            if all(val_name in USER_COLUMNS for val_name in columns):
+                return await user_cache.apply(index, deltas, sets, caps, where)
+            await _catch_up_decay(index)
+            updated = await storage.update_user(index, deltas, sets, caps, where)
+            if updated and ("bond_level" in deltas or "bond_level" in sets):
+                leaderboard.update(index, (await storage.get_values(index, ["bond_level"]))[0])
+            return updated
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
+            log.error(f"Failed to apply {deltas} and {sets} for user_id: {index} \n {error}")
+            raise
+
     @staticmethod
     async def get_column(val_name):
         if val_name not in Database.__user_table_fields: raise InvalidFieldException(field=val_name)
 
-        __sql = f"SELECT {val_name} FROM users"
-
         try:
-            cursor = query(__sql)
-            res = cursor.fetchall()
-            out = [data[0] for data in res]
-            return out
-        except (mariadb.Error, InvaludUserIdTypeException) as error:
+            return await storage.get_column(val_name)
+        except (*STORAGE_ERRORS, InvaludUserIdTypeException) as error:
             log.error(f"Failed to get {val_name} column \n {error}")
             raise
 
@@ -187,21 +276,34 @@ class Database():
     async def get_top_rows_by_column(col_name, order_name, limit):            
         return await Database.get_top_rows_by_column_exclude_uid(col_name, order_name, limit)
 
+    @staticmethod
+    async def get_bond_leaders(limit):
+        '''
+        Returns the usernames of the highest bonded users, not counting Brie.
+        Served from the in-memory leaderboard once it has been built.
+        '''
+        if leaderboard.ready:
+            return leaderboard.top(limit)
+        return await Database.get_top_rows_by_column_exclude_uid("username", "bond_level", limit, BRIES_ID)
+
+    @staticmethod
+    async def get_bond_rank(user_id):
+        '''
+        Returns (rank, total) for a user on the bond leaderboard, or None if they aren't on it.
+        '''
+        if not leaderboard.ready:
+            await load_leaderboard()
+        return leaderboard.rank(user_id)
+
     @staticmethod
     async def get_top_rows_by_column_exclude_uid(col_name, order_name, limit, uid = None):
         if col_name not in Database.__user_table_fields: raise InvalidFieldException(field=col_name)
 
-        if uid is None:
-            __sql = f"SELECT {col_name} FROM users ORDER BY {order_name} DESC LIMIT {limit}"
-        else:
-            __sql = f"SELECT {col_name} FROM users WHERE user_id != {uid} ORDER BY {order_name} DESC LIMIT {limit}"
+        if order_name not in Database.__user_table_fields: raise InvalidFieldException(field=order_name)
 
         try:
-            cursor = query(__sql)
-            res = cursor.fetchall()
-            out = [data[0] for data in res]
-            return out
-        except (mariadb.Error, InvalidFieldException) as error:
+            return await storage.get_top_rows(col_name, order_name, limit, uid)
+        except (*STORAGE_ERRORS, InvalidFieldException) as error:
             log.error(f"Failed to grab {col_name} ordered by {order_name} column \n {error}")
             raise
 
@@ -226,11 +328,13 @@ class Database():
         return await Database.get_value(user_id, "updated_at")
 
     @staticmethod
-    async def set_fed_brie_timestamp(user_id, fed_timestamp=dt.datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d %H:%M:%S")):
+    async def set_fed_brie_timestamp(user_id, fed_timestamp=None):
         '''
         Updates the last time a user has fed Brie.
         '''
-        await Database.set_value(user_id, "last_fed_brie_timestamp", f"'{fed_timestamp}'")
+        if fed_timestamp is None:
+            fed_timestamp = dt.datetime.now().replace(microsecond=0)
+        await Database.set_value(user_id, "last_fed_brie_timestamp", fed_timestamp)
 
     @staticmethod
     async def get_last_fed_timestamp(user_id):
@@ -248,55 +352,66 @@ class Database():
         # perhaps should do some formula to keep this on a 0-100 scale?
         return output
 
-async def do_decay():
-
-    __sql = f"""
-            UPDATE users 
-            SET free_feed = 0,
-                bonds_available = 0, 
-                affection = 
-                    CASE 
-                        WHEN last_fed_brie_timestamp <= NOW() - INTERVAL 1 DAY AND affection > 5 THEN affection - 5
-                        WHEN last_fed_brie_timestamp >= NOW() - INTERVAL 1 DAY AND affection > 1 THEN affection - 1
-                        WHEN last_fed_brie_timestamp <= NOW() - INTERVAL 1 DAY AND affection <= 0 THEN 0
-                        WHEN last_fed_brie_timestamp >= NOW() - INTERVAL 1 DAY AND affection <= 0 THEN 0
-                        ELSE affection
-                    END,
-                bond_level = 
-                    CASE 
-                        WHEN last_fed_brie_timestamp <= NOW() - INTERVAL 1 DAY AND bond_level > 5 THEN bond_level - 5
-                        WHEN last_fed_brie_timestamp >= NOW() - INTERVAL 1 DAY AND bond_level > 1 THEN bond_level - 1
-                        WHEN last_fed_brie_timestamp <= NOW() - INTERVAL 1 DAY AND bond_level <= 0 THEN 0
-                        WHEN last_fed_brie_timestamp >= NOW() - INTERVAL 1 DAY AND bond_level <= 0 THEN 0
-                        ELSE affection
-                    END
-            WHERE user_id != {BRIES_ID};
-            """
+def _in_chunk(after_id, last_id):
+    '''
+    Picks out the user ids in a decay chunk, the same way the SQL compares them.
+    '''
+    after_id, last_id = None if after_id is None else str(after_id), str(last_id)
+    return lambda user_id: (after_id is None or str(user_id) > after_id) and str(user_id) <= last_id
+
+async def do_decay(chunk_size=DECAY_CHUNK_SIZE, chunk_pause=DECAY_CHUNK_PAUSE):
+    '''
+    Apply the daily affection/bond_level decay to everyone but Brie.
+    The table is walked in user_id order, chunk_size rows per statement with a pause in between,
+    so no single statement locks the whole table while chat is still running.
+    Only the chunk's users are held off in the user cache while it's rewritten, the rest of chat carries on.
+    '''
+    start = time.monotonic()
+    cutoff = dt.datetime.now().replace(microsecond=0) - dt.timedelta(days=1)
+    after_id = None
+    chunks = 0
+    rows = 0
     try:
-        cursor = query(__sql)
-        res = cursor.fetchall()
-        log.info("Decayed affection and bond_level values in the database!")
-    except (mariadb.Error) as error:
-        log.error(f"Failed to decay affection and bond_level values! {error}")
-
-async def do_calc_happiness():    
-    happiness = 0
-    
-    old_happiness = await Database.get_value(BRIES_ID, "bond_level")
-
-    __sql = f"SELECT bond_level FROM users WHERE user_id != {BRIES_ID}"
-    
-    dict_cursor = await dict_query(__sql)
-    results = dict_cursor.fetchall()
-
-    for res in results:
-        bond_level = int(res["bond_level"])
-        if bond_level > 100:
-            happiness += 100
-        else:
-            happiness += bond_level
-
-    await Database.set_value(BRIES_ID, "bond_level", happiness)
-    log.info(f"Recalculated happiness! OLD: {old_happiness} NEW: {happiness}")
-    
-    await do_decay()
+        while True:
+            last_id = await storage.next_chunk(after_id, chunk_size)
+            if last_id is None:
+                break
+            async with user_cache.rewriting(_in_chunk(after_id, last_id)):
+                count = await storage.decay_chunk(after_id, last_id, cutoff, BRIES_ID)
+            after_id = last_id
+            chunks += 1
+            rows += count
+            await asyncio.sleep(chunk_pause)
+        log.info(f"Decayed affection and bond_level for {rows} users in {chunks} chunks ({time.monotonic() - start:.2f}s).")
+    except STORAGE_ERRORS as error:
+        log.error(f"Failed to decay affection and bond_level values after {chunks} chunks! {error}")
+
+    start = time.monotonic()
+    try:
+        async with user_cache.exclusive():
+            await load_leaderboard()
+        log.info(f"Rebuilt the bond leaderboard after decay ({time.monotonic() - start:.2f}s).")
+    except STORAGE_ERRORS as error:
+        log.error(f"Failed to rebuild the bond leaderboard after decay! {error}")
+
+async def do_calc_happiness(chunk_size=DECAY_CHUNK_SIZE, chunk_pause=DECAY_CHUNK_PAUSE):
+    '''
+    Nightly job: set Brie's happiness to the sum of everyone's bond_level (capped at 100 each), then run the decay.
+    With lazy decay there is no sweep, the sum and the leaderboard read decayed values on the fly instead.
+    '''
+    start = time.monotonic()
+
+    # Flushes the cache first so the sum sees every pending change
+    async with user_cache.exclusive():
+        flushed = time.monotonic()
+        old_happiness, happiness = await storage.calc_happiness(BRIES_ID, lazy_decay)
+    log.info(f"Recalculated happiness! OLD: {old_happiness} NEW: {happiness} (flush {flushed - start:.2f}s, sum {time.monotonic() - flushed:.2f}s)")
+
+    if not lazy_decay:
+        await do_decay(chunk_size, chunk_pause)
+        return
+
+    start = time.monotonic()
+    async with user_cache.exclusive():
+        await load_leaderboard()
+    log.info(f"Rebuilt the bond leaderboard with lazily decayed values ({time.monotonic() - start:.2f}s).")
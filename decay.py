@@ -0,0 +1,91 @@
+# The daily decay rules, written so any number of missed days can be applied at once.
+#
+# Each day, affection and bond_level drop by 1 if the user fed Brie within the last day (values of 1 or less stay put),
+# or by 5 if they didn't (values of 5 or less stay put). Negative values are reset to 0.
+# The free cracker and any unused bond attempts are taken away as well.
+#
+# A row remembers the last day it was decayed in decayed_through. Days are counted by date,
+# and a missed day counts as "fed" if the last feeding was on or after the day before it.
+
+def pending_steps(decayed_through, last_fed, today):
+    '''
+    Returns (fed_steps, unfed_steps) owed by a row as of today.
+    A row that was never stamped owes nothing, it just gets stamped.
+    '''
+    if decayed_through is None:
+        return 0, 0
+    days = (today - decayed_through).days
+    if days <= 0:
+        return 0, 0
+    fed = 0
+    if last_fed is not None:
+        fed = min(days, max(0, (last_fed.date() - decayed_through).days + 1))
+    return fed, days - fed
+
+def decay_value(value, fed_steps, unfed_steps):
+    '''
+    Apply fed_steps "fed" days followed by unfed_steps "unfed" days to one value.
+    '''
+    if fed_steps:
+        if value > 1:
+            value -= min(fed_steps, value - 1)
+        elif value <= 0:
+            value = 0
+    if unfed_steps:
+        if value > 5:
+            value -= 5 * min(unfed_steps, (value - 1) // 5)
+        elif value <= 0:
+            value = 0
+    return value
+
+def catch_up(record, today):
+    '''
+    Bring a cached users row up to today. Returns the names of the fields it changed.
+    '''
+    if record.decayed_through == today:
+        return ()
+    fed, unfed = pending_steps(record.decayed_through, record.last_fed_brie_timestamp, today)
+    record.set("decayed_through", today)
+    if not fed and not unfed:
+        return ("decayed_through",)
+    record.set("affection", decay_value(record.affection, fed, unfed))
+    record.set("bond_level", decay_value(record.bond_level, fed, unfed))
+    record.set("free_feed", 0)
+    record.set("bonds_available", 0)
+    return ("decayed_through", "affection", "bond_level", "free_feed", "bonds_available")
+
+def sql_days_owed(sql):
+    return sql.days_between(sql.today, f"COALESCE(decayed_through, {sql.today})")
+
+def sql_decayed(column, sql):
+    '''
+    SQL expression for what column will be once the row is caught up to today.
+    Usable in a SELECT to read decayed values without writing them, or in an UPDATE.
+    sql is the storage backend, which knows how its dialect spells the date and min/max functions.
+    '''
+    days = sql_days_owed(sql)
+    fed_since = sql.days_between(sql.date_of("last_fed_brie_timestamp"), "decayed_through")
+    fed = sql.least(days, sql.greatest("0", f"COALESCE({fed_since} + 1, 0)"))
+    unfed = f"({days} - {fed})"
+    after_fed = (
+        f"(CASE WHEN {column} > 1 THEN {column} - {sql.least(fed, f'{column} - 1')} "
+        f"WHEN {column} <= 0 AND {fed} > 0 THEN 0 ELSE {column} END)"
+    )
+    return (
+        f"(CASE WHEN {after_fed} > 5 THEN {after_fed} - 5 * {sql.least(unfed, sql.int_div(f'{after_fed} - 1', 5))} "
+        f"WHEN {after_fed} <= 0 AND {unfed} > 0 THEN 0 ELSE {after_fed} END)"
+    )
+
+def sql_catch_up_assignments(sql):
+    '''
+    SET clause that catches a row up to today. decayed_through is assigned last
+    because MariaDB evaluates assignments left to right.
+    '''
+    days = sql_days_owed(sql)
+    return (
+        f"affection = {sql_decayed('affection', sql)}, "
+        f"bond_level = {sql_decayed('bond_level', sql)}, "
+        f"free_feed = CASE WHEN {days} > 0 THEN 0 ELSE free_feed END, "
+        f"bonds_available = CASE WHEN {days} > 0 THEN 0 ELSE bonds_available END, "
+        f"decayed_through = {sql.today}"
+    )
@@ -0,0 +1,116 @@
+'''
+A local stand-in for Twitch's EventSub WebSocket, for trying out the live status handling without going live.
+
+    python eventsub_standin.py [port]
+
+Then in config.ini under [Channel]:
+
+    EventSub URL=ws://localhost:8080/ws
+    EventSub Subscriptions URL=http://localhost:8080/eventsub/subscriptions
+
+Push is only tried with an EventSub Refresh Token under [Password]. The stand-in doesn't check the token,
+but the bot still gets it from Twitch.
+
+and flip the stream with:
+
+    curl -X POST localhost:8080/trigger/online
+    curl -X POST localhost:8080/trigger/offline
+    curl -X POST localhost:8080/trigger/reconnect
+'''
+import asyncio
+import datetime as dt
+import json
+import sys
+import uuid
+from aiohttp import web
+
+KEEPALIVE_SECONDS = 10
+
+def message(kind, payload, subscription_type=None):
+    metadata = {
+        "message_id": str(uuid.uuid4()),
+        "message_type": kind,
+        "message_timestamp": dt.datetime.utcnow().isoformat() + "Z"
+    }
+    if subscription_type is not None:
+        metadata["subscription_type"] = subscription_type
+        metadata["subscription_version"] = "1"
+    return json.dumps({"metadata": metadata, "payload": payload})
+
+class StandIn:
+    def __init__(self):
+        self.sockets = {}           # session id -> websocket
+        self.subscriptions = []
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session_id = request.query.get("session") or str(uuid.uuid4())
+        self.sockets[session_id] = ws
+        session = {"id": session_id, "status": "connected", "keepalive_timeout_seconds": KEEPALIVE_SECONDS, "reconnect_url": None}
+        await ws.send_str(message("session_welcome", {"session": session}))
+        print(f"session {session_id} connected")
+        try:
+            while not ws.closed:
+                try:
+                    await ws.receive(timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    await ws.send_str(message("session_keepalive", {}))
+        finally:
+            if self.sockets.get(session_id) is ws:
+                del self.sockets[session_id]
+            print(f"session {session_id} gone")
+        return ws
+
+    async def subscribe(self, request):
+        body = await request.json()
+        subscription = {
+            "id": str(uuid.uuid4()),
+            "status": "enabled",
+            "type": body["type"],
+            "version": body["version"],
+            "condition": body["condition"],
+            "transport": body["transport"],
+            "created_at": dt.datetime.utcnow().isoformat() + "Z",
+            "cost": 0
+        }
+        self.subscriptions.append(subscription)
+        print(f"subscribed to {body['type']} for {body['condition']}")
+        return web.json_response({"data": [subscription], "total": len(self.subscriptions), "total_cost": 0, "max_total_cost": 10}, status=202)
+
+    async def trigger(self, request):
+        what = request.match_info["what"]
+        if what == "reconnect":
+            host = request.host
+            for session_id, ws in list(self.sockets.items()):
+                url = f"ws://{host}/ws?session={session_id}"
+                await ws.send_str(message("session_reconnect", {"session": {"id": session_id, "status": "reconnecting", "reconnect_url": url}}))
+            return web.Response(text="sent reconnect\n")
+
+        event_type = f"stream.{what}"
+        sent = 0
+        for subscription in self.subscriptions:
+            if subscription["type"] != event_type:
+                continue
+            ws = self.sockets.get(subscription["transport"]["session_id"])
+            if ws is None:
+                continue
+            broadcaster_id = subscription["condition"]["broadcaster_user_id"]
+            event = {"broadcaster_user_id": broadcaster_id, "broadcaster_user_login": "standin", "broadcaster_user_name": "StandIn"}
+            if what == "online":
+                event.update({"id": str(uuid.uuid4()), "type": "live", "started_at": dt.datetime.utcnow().isoformat() + "Z"})
+            await ws.send_str(message("notification", {"subscription": subscription, "event": event}, event_type))
+            sent += 1
+        return web.Response(text=f"sent {event_type} to {sent} subscriptions\n")
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    standin = StandIn()
+    app = web.Application()
+    app.router.add_get("/ws", standin.websocket)
+    app.router.add_post("/eventsub/subscriptions", standin.subscribe)
+    app.router.add_post("/trigger/{what:online|offline|reconnect}", standin.trigger)
+    web.run_app(app, port=port)
+
+if __name__ == "__main__":
+    main()
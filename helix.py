@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+log = logging.getLogger("chatbot")
+
+# Priority lanes, lower goes first
+PRIORITY_HIGH = 0           # live status, the bot refuses commands based on it
+PRIORITY_NORMAL = 1         # lookups a chatter is waiting on
+PRIORITY_BACKGROUND = 2     # anything that can wait
+
+# Requests left in the bucket that a lane won't touch, so background work can't starve live checks
+LANE_RESERVE = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 5, PRIORITY_BACKGROUND: 20}
+
+HELIX_DEFAULT_LIMIT = 800   # bucket size until twitch tells us otherwise
+HELIX_MAX_RETRIES = 5
+HELIX_RETRY_BASE = 0.5      # seconds, doubled on each retry
+HELIX_RETRY_CAP = 8.0
+
+class RateLimiter:
+    '''
+    Token bucket that mirrors the one twitch keeps for us.
+    Every response's Ratelimit-Limit, Ratelimit-Remaining and Ratelimit-Reset headers replace our estimate,
+    and in between each request takes one token. When the bucket is empty, waiters are let through
+    by priority once the reset time passes.
+    '''
+    def __init__(self, loop, limit=HELIX_DEFAULT_LIMIT):
+        self.loop = loop
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at = 0.0         # unix time the bucket is full again
+        self._waiters = []          # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def update(self, headers):
+        try:
+            self.limit = int(headers["Ratelimit-Limit"])
+            self.remaining = int(headers["Ratelimit-Remaining"])
+            self.reset_at = float(headers["Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        self._wake()
+
+    def _available(self, priority):
+        if self.remaining < self.limit and time.time() >= self.reset_at:
+            self.remaining = self.limit
+        return self.remaining > LANE_RESERVE.get(priority, 0)
+
+    async def acquire(self, priority):
+        if not self._waiters and self._available(priority):
+            self.remaining -= 1
+            return False
+        future = self.loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wake()
+        await future
+        return True
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if not self._available(priority):
+                break
+            heapq.heappop(self._waiters)
+            self.remaining -= 1
+            future.set_result(None)
+        if self._waiters and self._timer is None:
+            delay = max(0.05, self.reset_at - time.time())
+            self._timer = self.loop.call_later(delay, self._timer_fired)
+
+    def _timer_fired(self):
+        self._timer = None
+        self._wake()
+
+class EndpointStats:
+    '''
+    Counters for one endpoint, see HelixClient.stats().
+    '''
+    __slots__ = ("requests", "errors", "retries", "throttled", "waited", "total_latency", "max_latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttled = 0      # requests answered with 429
+        self.waited = 0         # requests that had to wait for the bucket
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self):
+        info = {field: getattr(self, field) for field in EndpointStats.__slots__}
+        info["avg_latency"] = self.total_latency / self.requests if self.requests else 0.0
+        return info
+
+class HelixClient:
+    '''
+    Requests against the twitch api with rate limiting, retries and per endpoint stats.
+    429s wait for the reset time twitch sends, server and connection errors are retried with
+    capped, jittered backoff, and a 401 asks the TokenManager to check the token before retrying.
+
+    session has to be set to the shared aiohttp.ClientSession before the first request.
+    '''
+    def __init__(self, tokens, loop):
+        self.tokens = tokens
+        self.loop = loop
+        self.session = None
+        self._limiters = {}     # host -> RateLimiter, helix and kraken are limited separately
+        self._stats = {}        # endpoint path -> EndpointStats
+
+    def _limiter(self, host):
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters[host] = RateLimiter(self.loop)
+        return limiter
+
+    def _endpoint_stats(self, path):
+        stats = self._stats.get(path)
+        if stats is None:
+            stats = self._stats[path] = EndpointStats()
+        return stats
+
+    @staticmethod
+    def _backoff(attempt):
+        return random.uniform(0, min(HELIX_RETRY_CAP, HELIX_RETRY_BASE * 2 ** attempt))
+
+    async def get(self, url, priority=PRIORITY_NORMAL):
+        return await self.request("GET", url, priority=priority)
+
+    async def post(self, url, json, priority=PRIORITY_NORMAL, tokens=None, retry_unauthorized=True):
+        return await self.request("POST", url, json=json, priority=priority, tokens=tokens, retry_unauthorized=retry_unauthorized)
+
+    async def request(self, method, url, json=None, priority=PRIORITY_NORMAL, tokens=None, retry_unauthorized=True):
+        '''
+        Returns the json body of the response.
+        After HELIX_MAX_RETRIES failed attempts the last error body is returned, or the last connection error raised.
+        tokens is a TokenManager to use instead of the app token. With retry_unauthorized off a 401 is returned
+        like any other client error, for requests where it means the token isn't allowed rather than expired.
+        '''
+        tokens = tokens or self.tokens
+        parts = urlsplit(url)
+        limiter = self._limiter(parts.netloc)
+        stats = self._endpoint_stats(parts.path)
+        attempt = 0
+        while True:
+            if await limiter.acquire(priority):
+                stats.waited += 1
+            token = await tokens.get_token()
+            start = time.monotonic()
+            retry_after = None
+            try:
+                async with self.session.request(method, url, json=json, headers=tokens.headers()) as response:
+                    limiter.update(response.headers)
+                    status = response.status
+                    output = await response.json()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                stats.errors += 1
+                if attempt >= HELIX_MAX_RETRIES:
+                    raise
+                log.warning(f"Request on {url} failed, retrying.", exc_info=True)
+                status = None
+            finally:
+                latency = time.monotonic() - start
+                stats.requests += 1
+                stats.total_latency += latency
+                stats.max_latency = max(stats.max_latency, latency)
+
+            if status is not None:
+                if status < 400:
+                    return output
+                stats.errors += 1
+                log.warning(f"Got status {status} error while requesting on {url}.")
+                if attempt >= HELIX_MAX_RETRIES or (status < 500 and status not in (401, 429)) or (status == 401 and not retry_unauthorized):
+                    return output
+                if status == 401:
+                    await tokens.unauthorized(token)
+                    retry_after = 0
+                elif status == 429:
+                    # limiter.update already emptied the bucket until the reset time, acquire waits for it
+                    stats.throttled += 1
+
+            attempt += 1
+            stats.retries += 1
+            await asyncio.sleep(self._backoff(attempt) if retry_after is None else retry_after)
+
+    def stats(self):
+        '''
+        Returns {endpoint path: {counter: value}} for every endpoint requested so far.
+        '''
+        return {path: stats.as_dict() for path, stats in self._stats.items()}
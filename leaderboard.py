@@ -0,0 +1,68 @@
+import logging
+from itertools import islice
+from sortedcontainers import SortedList
+
+log = logging.getLogger("chatbot")
+
+class Leaderboard:
+    '''
+    In-memory ranking of users by bond_level.
+    Entries are kept sorted as (-bond_level, user_id), so the top of the list is the highest bond
+    and ties are broken by user_id. Updates, top-N and rank lookups are all O(log n).
+    '''
+    def __init__(self, exclude=()):
+        self.exclude = set(exclude)     # user ids that never show up, i.e. Brie herself
+        self.ready = False              # False until the first load, callers should fall back to the db
+        self._ranking = SortedList()
+        self._users = {}                # user_id -> (bond_level, username)
+
+    def load(self, rows):
+        '''
+        Replace the whole ranking from (user_id, username, bond_level) rows.
+        '''
+        users = {}
+        for user_id, username, bond_level in rows:
+            user_id = str(user_id)
+            if user_id not in self.exclude:
+                users[user_id] = (bond_level, username)
+        self._users = users
+        self._ranking = SortedList((-bond_level, user_id) for user_id, (bond_level, _) in users.items())
+        self.ready = True
+        log.info(f"Built the bond leaderboard with {len(users)} users.")
+
+    def update(self, user_id, bond_level, username=None):
+        '''
+        Insert a user or move them to their new bond_level.
+        '''
+        user_id = str(user_id)
+        if user_id in self.exclude:
+            return
+        old = self._users.get(user_id)
+        if old is not None:
+            if username is None:
+                username = old[1]
+            if old[0] == bond_level:
+                self._users[user_id] = (bond_level, username)
+                return
+            self._ranking.remove((-old[0], user_id))
+        self._users[user_id] = (bond_level, username)
+        self._ranking.add((-bond_level, user_id))
+
+    def top(self, limit):
+        '''
+        Returns the usernames of the highest bonded users, best first.
+        '''
+        return [self._users[user_id][1] for _, user_id in islice(self._ranking, limit)]
+
+    def rank(self, user_id):
+        '''
+        Returns (rank, total) with rank starting at 1, or None for an unknown user.
+        Users with the same bond_level share the best rank among them.
+        '''
+        entry = self._users.get(str(user_id))
+        if entry is None:
+            return None
+        return self._ranking.bisect_left((-entry[0], "")) + 1, len(self._ranking)
+
+    def __len__(self):
+        return len(self._ranking)
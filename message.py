@@ -0,0 +1,53 @@
+class MessageContext:
+    '''
+    Who sent a chat message, read once from the Twitch IRCv3 tags that come with it.
+    has_tags is False if Twitch sent no tags, in which case the privilege flags can't be trusted
+    and callers should fall back to asking the API.
+    '''
+    __slots__ = ("user", "user_id", "display_name", "badges", "is_mod", "is_broadcaster", "is_subscriber", "has_tags")
+
+    def __init__(self, user, tags=None):
+        tags = tags or {}
+        self.user = user
+        self.user_id = tags.get("user-id") or ""
+        self.display_name = tags.get("display-name") or user
+        self.badges = MessageContext.parse_badges(tags.get("badges"))
+        self.is_broadcaster = "broadcaster" in self.badges
+        self.is_mod = tags.get("mod") == "1" or "moderator" in self.badges
+        self.is_subscriber = tags.get("subscriber") == "1" or "subscriber" in self.badges
+        self.has_tags = bool(tags)
+
+    @property
+    def is_privileged(self):
+        return self.is_mod or self.is_broadcaster
+
+    @property
+    def role(self):
+        '''
+        The role cooldowns are looked up by, one of cooldowns.ROLES.
+        '''
+        if self.is_privileged:
+            return "mod"
+        if self.is_subscriber:
+            return "subscriber"
+        return "viewer"
+
+    @staticmethod
+    def from_event(event):
+        '''
+        Build the context for an irc pubmsg event. The irc library hands tags over as a list of {"key", "value"} dicts.
+        '''
+        tags = {d["key"]: d["value"] for d in event.tags or ()}
+        return MessageContext(event.source.nick.lower(), tags)
+
+    @staticmethod
+    def parse_badges(value):
+        '''
+        "moderator/1,subscriber/12" -> {"moderator": "1", "subscriber": "12"}
+        '''
+        badges = {}
+        if value:
+            for badge in value.split(","):
+                name, _, version = badge.partition("/")
+                badges[name] = version
+        return badges
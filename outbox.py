@@ -0,0 +1,143 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+log = logging.getLogger("chatbot")
+
+# Priority classes, lower goes first
+SEND_HIGH = 0       # announcements like the hydration reminder
+SEND_NORMAL = 1     # command output
+SEND_LOW = 2        # error and "you can't do that" replies
+
+# Seconds a message may wait before it's not worth sending anymore
+SEND_DEADLINES = {SEND_HIGH: 120.0, SEND_NORMAL: 30.0, SEND_LOW: 10.0}
+
+# Twitch lets an account send 20 messages per 30 seconds, or 100 in channels where it is a moderator.
+# The window is a little longer than twitch's so clock differences don't push us over.
+SEND_WINDOW = 31.0
+SEND_LIMIT = 20
+SEND_LIMIT_MOD = 100
+CHANNEL_INTERVAL = 1.0      # non-moderators also get one message per second per channel
+
+class OutgoingMessage:
+    __slots__ = ("target", "text", "priority", "expires_at")
+
+    def __init__(self, target, text, priority, expires_at):
+        self.target = target
+        self.text = text
+        self.priority = priority
+        self.expires_at = expires_at
+
+class ChatOutbox:
+    '''
+    Queue between the bot and connection.privmsg that keeps us under twitch's send limits.
+    Sends are counted in a sliding window per account plus a per channel pace, both relaxed
+    in channels where the bot is a moderator. When messages have to wait, the highest
+    priority goes first and anything past its deadline is dropped.
+
+    send is called as send(target, text) to actually put a message on the wire.
+    '''
+    def __init__(self, send):
+        self.send = send
+        self._queues = {}                       # target -> heap of (priority, seq, OutgoingMessage)
+        self._seq = itertools.count()
+        self._sent_times = collections.deque()  # when each message in the window went out
+        self._channel_last = {}                 # target -> when the last message went out there
+        self._moderated = set()                 # targets where the bot is a moderator
+        self._wakeup = None
+
+        self.sent = collections.Counter()       # by priority
+        self.dropped = collections.Counter()    # by priority, stale or failed to send
+
+    def put(self, target, text, priority=SEND_NORMAL, deadline=None):
+        if deadline is None:
+            deadline = SEND_DEADLINES.get(priority, SEND_DEADLINES[SEND_NORMAL])
+        message = OutgoingMessage(target, text, priority, time.monotonic() + deadline)
+        heapq.heappush(self._queues.setdefault(target, []), (priority, next(self._seq), message))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def set_moderator(self, target, is_mod):
+        if is_mod:
+            self._moderated.add(target)
+        else:
+            self._moderated.discard(target)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        return {
+            "sent": sum(self.sent.values()),
+            "queued": self.queued,
+            "dropped": sum(self.dropped.values()),
+            "sent_by_priority": dict(self.sent),
+            "dropped_by_priority": dict(self.dropped)
+        }
+
+    def _ready_at(self, target, now):
+        '''
+        Earliest time a message to target can go out without breaking a limit.
+        '''
+        moderated = target in self._moderated
+        limit = SEND_LIMIT_MOD if moderated else SEND_LIMIT
+        ready = now
+        if len(self._sent_times) >= limit:
+            ready = self._sent_times[-limit] + SEND_WINDOW
+        if not moderated and target in self._channel_last:
+            ready = max(ready, self._channel_last[target] + CHANNEL_INTERVAL)
+        return ready
+
+    def _next(self, now):
+        '''
+        Returns (message, None) for the message to send now, or (None, seconds to wait).
+        '''
+        while self._sent_times and self._sent_times[0] <= now - SEND_WINDOW:
+            self._sent_times.popleft()
+        best = None
+        wait = None
+        for target, queue in list(self._queues.items()):
+            while queue and queue[0][2].expires_at <= now:
+                _, _, stale = heapq.heappop(queue)
+                self.dropped[stale.priority] += 1
+                log.info(f"Dropped a message to {target} that waited too long: {stale.text}")
+            if not queue:
+                del self._queues[target]
+                continue
+            ready = self._ready_at(target, now)
+            if ready <= now:
+                if best is None or queue[0][:2] < best[:2]:
+                    best = queue[0]
+            else:
+                delay = min(ready, queue[0][2].expires_at) - now
+                wait = delay if wait is None else min(wait, delay)
+        if best is None:
+            return None, wait
+        heapq.heappop(self._queues[best[2].target])
+        return best[2], None
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            message, wait = self._next(time.monotonic())
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                self.send(message.target, message.text)
+            except:
+                self.dropped[message.priority] += 1
+                log.exception(f"Failed to send a message to {message.target}")
+                continue
+            now = time.monotonic()
+            self._sent_times.append(now)
+            self._channel_last[message.target] = now
+            self.sent[message.priority] += 1
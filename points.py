@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+log = logging.getLogger("chatbot")
+
+POINTS_BALANCE_TTL = 60         # seconds a balance fetched from StreamElements is trusted
+POINTS_FLUSH_INTERVAL = 5       # seconds between pushes of pending debits to StreamElements
+POINTS_JOURNAL = "points_journal.json"  # unflushed debits, so a crash doesn't hand out free cheese
+
+class Wallet:
+    '''
+    A viewer's StreamElements points as far as the bot knows.
+    balance is the last amount StreamElements reported plus whatever has been pushed since,
+    pending is the net change the bot has made and not pushed yet, flushing is the part of it being pushed right now.
+    '''
+    __slots__ = ("balance", "fetched_at", "pending", "flushing", "lock")
+
+    def __init__(self):
+        self.balance = None
+        self.fetched_at = 0.0
+        self.pending = 0
+        self.flushing = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def available(self):
+        return self.balance + self.pending
+
+    def debit(self, amount):
+        self.pending -= amount
+
+class PointsLedger:
+    '''
+    Sits in front of StreamElementsAPI so purchases don't wait on two HTTP round trips.
+    Debits are applied locally straight away and pushed to StreamElements as one net change
+    per user by flush(), all in one bulk request. Balances are re-read from StreamElements once
+    they are older than POINTS_BALANCE_TTL, which picks up points earned by watching.
+    Unflushed debits are journaled to disk and picked up again on the next start. The journal is written
+    on a worker thread, and debits made while a write is running are saved together by the next one.
+    '''
+    def __init__(self, se, journal_path=POINTS_JOURNAL, ttl=POINTS_BALANCE_TTL):
+        self.se = se
+        self.journal_path = journal_path
+        self.ttl = ttl
+        self._wallets = {}
+        self._flush_lock = None     # created on first use so it binds to the running loop
+        self._journal_task = None   # the running journal write, if any
+        self._journal_dirty = False # pending changed since the running write took its copy
+        self._load_journal()
+
+    def _wallet(self, user):
+        wallet = self._wallets.get(user)
+        if wallet is None:
+            wallet = self._wallets[user] = Wallet()
+        return wallet
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_path) as f:
+                pending = json.load(f)
+        except FileNotFoundError:
+            return
+        except:
+            log.exception("Failed to load the points journal. Unflushed debits from the last run are lost.")
+            return
+        for user, amount in pending.items():
+            self._wallet(user).pending += amount
+        if pending:
+            log.info(f"Recovered unflushed points changes for {len(pending)} users from the journal.")
+
+    def _save_journal(self, pending):
+        tmp_path = self.journal_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(pending, f)
+            os.replace(tmp_path, self.journal_path)
+        except:
+            log.exception("Failed to write the points journal.")
+
+    async def _write_journal(self):
+        loop = asyncio.get_event_loop()
+        while self._journal_dirty:
+            self._journal_dirty = False
+            pending = {user: wallet.pending for user, wallet in self._wallets.items() if wallet.pending}
+            await loop.run_in_executor(None, self._save_journal, pending)
+
+    def _journal_changed(self):
+        '''
+        Get the journal written without waiting for it.
+        '''
+        self._journal_dirty = True
+        if self._journal_task is None or self._journal_task.done():
+            self._journal_task = asyncio.ensure_future(self._write_journal())
+        return self._journal_task
+
+    async def _refresh(self, user, wallet):
+        if wallet.flushing:
+            # can't tell if a fresh balance would include the change in flight, wait for the flush to settle it
+            async with self._flush_lock:
+                pass
+        if wallet.balance is None or time.monotonic() - wallet.fetched_at > self.ttl:
+            wallet.balance = await self.se.get_user_points(user)
+            wallet.fetched_at = time.monotonic()
+
+    async def get_points(self, user):
+        '''
+        Returns the points a user can spend right now.
+        '''
+        wallet = self._wallet(user)
+        async with wallet.lock:
+            await self._refresh(user, wallet)
+            return wallet.available
+
+    @asynccontextmanager
+    async def reserve(self, user):
+        '''
+        Hold a user's wallet for the length of a purchase:
+
+            async with ledger.reserve(user) as wallet:
+                cost = ...check wallet.available...
+                wallet.debit(cost)
+
+        Other purchases by the same user wait until the block is done, so they can't overspend.
+        '''
+        wallet = self._wallet(user)
+        async with wallet.lock:
+            await self._refresh(user, wallet)
+            before = wallet.pending
+            try:
+                yield wallet
+            finally:
+                if wallet.pending != before:
+                    self._journal_changed()
+
+    async def flush(self):
+        '''
+        Push every user's net pending change to StreamElements.
+        Failed users keep their pending change for the next flush.
+        Also forgets idle users whose balance has expired.
+        '''
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            batch = [(user, wallet, wallet.pending) for user, wallet in self._wallets.items() if wallet.pending]
+            if batch:
+                for _, wallet, amount in batch:
+                    wallet.flushing = amount
+                results = await asyncio.gather(*(self.se.add_user_points(user, amount) for user, _, amount in batch), return_exceptions=True)
+                failed = 0
+                for (user, wallet, amount), result in zip(batch, results):
+                    wallet.flushing = 0
+                    if isinstance(result, Exception):
+                        failed += 1
+                        log.error(f"Failed to push points change for {user}: {result}")
+                        continue
+                    wallet.pending -= amount
+                    if wallet.balance is not None:
+                        wallet.balance += amount
+                log.debug(f"Flushed points changes for {len(batch) - failed}/{len(batch)} users.")
+                await asyncio.shield(self._journal_changed())
+
+            now = time.monotonic()
+            for user in [user for user, wallet in self._wallets.items()
+                         if not wallet.pending and not wallet.lock.locked() and now - wallet.fetched_at > self.ttl]:
+                del self._wallets[user]
@@ -0,0 +1,92 @@
+import inspect
+
+# Who may run a command
+PRIVILEGE_ANYONE = None
+PRIVILEGE_MOD = "mod"       # moderators and the broadcaster
+PRIVILEGE_HOST = "host"     # only the host from the config
+
+# Values a command can ask for by naming a parameter, worked out from the message.
+#   user : user name
+#   uid : user ID
+#   args : rest of the message split into a list
+#   message : rest of the message as a string
+#   mention_list : list of user names mentioned by the message, without the @
+#   context : MessageContext with the sender's badges and mod status
+INJECTORS = {
+    "user": lambda context, args: context.user,
+    "uid": lambda context, args: context.user_id,
+    "args": lambda context, args: args,
+    "message": lambda context, args: " ".join(args),
+    "mention_list": lambda context, args: [word[1:] for word in args if word.startswith("@") and len(word) > 1],
+    "context": lambda context, args: context
+}
+
+class Command:
+    '''
+    Everything dispatch needs to know about a command, worked out once when it's registered.
+    inject is a tuple of (parameter name, injector) for the parameters the function takes.
+    cooldown is the command's own cooldown in seconds, None to use the default. The config can override it, see cooldowns.py.
+    bond is the bonds.json entry the command runs, which reloads of the file aren't allowed to drop.
+    '''
+    __slots__ = ("name", "func", "inject", "cooldown", "allow_online", "privilege", "bond")
+
+    def __init__(self, name, func, cooldown=None, allow_online=False, privilege=PRIVILEGE_ANYONE, bond=None):
+        self.name = name
+        self.func = func
+        self.inject = tuple((param, INJECTORS[param]) for param in inspect.signature(func).parameters if param in INJECTORS)
+        self.cooldown = cooldown
+        self.allow_online = allow_online
+        self.privilege = privilege
+        self.bond = bond
+
+    def kwargs(self, context, args):
+        return {param: injector(context, args) for param, injector in self.inject}
+
+    def jumps_queue(self, context, host):
+        '''
+        Whether this message goes in the worker pool's priority lane: a host or mod command sent by the host or a mod.
+        Decided from the sender, so nobody else can get in the lane just by typing the command.
+        '''
+        return self.privilege is not None and (context.user == host or context.is_privileged)
+
+class CommandRegistry:
+    '''
+    Command names and aliases mapped to their Command.
+    '''
+    def __init__(self):
+        self._commands = {}     # name or alias -> Command
+        self.names = []         # real names only, in registration order
+
+    def register(self, name, func, aliases=(), **options):
+        '''
+        Add a command. func is a coroutine function, options are the Command settings.
+        '''
+        command = Command(name, func, **options)
+        for key in (name, *aliases):
+            if key in self._commands:
+                raise ValueError(f"Command {key} is already registered.")
+        for key in (name, *aliases):
+            self._commands[key] = command
+        self.names.append(name)
+        return command
+
+    def get(self, name):
+        return self._commands.get(name)
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def __iter__(self):
+        return (self._commands[name] for name in self.names)
+
+# The built in commands, filled in by the @command decorator as commands.py is loaded
+BUILTIN_COMMANDS = []
+
+def command(name=None, aliases=(), **options):
+    '''
+    Mark a CommandHandler method as a chat command. The name defaults to the method name without cmd_.
+    '''
+    def decorator(func):
+        BUILTIN_COMMANDS.append((name or func.__name__[4:], func.__name__, aliases, options))
+        return func
+    return decorator
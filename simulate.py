@@ -0,0 +1,338 @@
+'''
+Offline economy simulator for balancing store.json, bonds.json and the decay rules.
+
+Runs a population of made up viewers through day after day of the game, using the bot's own
+rules as NumPy kernels over every viewer at once, and reports where affection, bond levels and SP end up.
+
+    python simulate.py --viewers 100000 --days 120
+    python simulate.py --sweep bonds.hug.worth=1,2,3 --sweep store.gifts.puzzle.cost=5,10 --workers 4
+
+A --sweep on bonds.* or store.* edits that field of the loaded JSON, anything else is one of the
+simulation parameters in DEFAULT_PARAMS. Every combination of the swept values is run in a process pool.
+'''
+import argparse
+import copy
+import datetime
+import itertools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from content import compile_bonds, GIFT_REWARDS, MAX_AFFECTION
+from storefront import StoreCatalog, StoreHandler, PUZZLE_ODDS
+
+# How the made up viewers behave. Rates are per day, a viewer only does anything on days they show up.
+DEFAULT_PARAMS = {
+    "viewers": 100000,
+    "days": 90,
+    "start": "2020-03-01",      # first simulated day, picks the store season
+    "seed": 1,
+    "activity": 0.3,            # average chance a viewer is in chat on a given day, varies per viewer
+    "sp_per_day": 8.0,          # average SP earned on a day in chat, varies per viewer
+    "feeds_per_day": 1.5,       # average paid feeds wanted on a day in chat
+    "buy_rate": 0.2,            # chance of trying to buy a bond item
+    "gift_rate": 0.1,           # chance of giving a puzzle
+    "top": 5,                   # leaderboard size shown in chat, churn is measured on it
+}
+
+PERCENTILES = (10, 50, 90, 99)
+
+def decay_day(values, fed):
+    '''
+    One night of decay.decay_value for every viewer: fed viewers lose 1, the rest lose 5,
+    nobody drops below where the rule stops and negative values are reset to 0.
+    '''
+    step = np.where(fed, 1, 5)
+    return np.where(values > step, values - step, np.maximum(values, 0))
+
+def roll_bonds(chances, bond_index, affection, rng):
+    '''
+    Bond.roll for many attempts: look up each attempt's chance in its bond's success curve and roll 1-100.
+    chances holds every bond's Bond.chances, affection never goes past MAX_AFFECTION here.
+    '''
+    return chances[bond_index, np.minimum(affection, MAX_AFFECTION)] >= rng.integers(1, 101, len(bond_index))
+
+def gamble_puzzles(reward, count, rng, odds=PUZZLE_ODDS):
+    '''
+    StoreHandler.gamble_puzzle for count puzzles. Returns (affection rewarded, reward type index) with
+    0 for common, 1 for uncommon and 2 for rare.
+    '''
+    # the reward type of every roll from 1 to 100, as the store itself decides it
+    kinds = np.array([0] + [GIFT_REWARDS.index(StoreHandler.puzzle_reward_type(rand, *odds)) for rand in range(1, 101)])
+    kind = kinds[rng.integers(1, 101, count)]
+    values = np.array([reward[name] for name in GIFT_REWARDS])
+    return values[kind], kind
+
+def add_affection(affection, who, amount):
+    affection[who] = np.minimum(affection[who] + amount, 100)
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def apply_override(params, store, bonds, key, value):
+    '''
+    Set one swept value. "bonds.hug.worth" and "store.gifts.puzzle.cost" edit the JSON, anything else is a parameter.
+    '''
+    section, _, path = key.partition(".")
+    if section not in ("bonds", "store"):
+        if key not in params:
+            raise KeyError(f"Unknown simulation parameter {key}")
+        params[key] = value
+        return
+    target = bonds if section == "bonds" else store
+    *parents, field = path.split(".")
+    for part in parents:
+        target = target[part]
+    if field not in target:
+        raise KeyError(f"{key} isn't in {section}.json")
+    target[field] = value
+
+class Economy:
+    '''
+    The store and bonds as arrays the kernels index into.
+    '''
+    def __init__(self, store, bond_data):
+        self.catalog = StoreCatalog(store)
+        self.bonds = list(compile_bonds(bond_data).values())
+        self.item_names = list(self.catalog.items)
+        self.item_costs = np.array([self.catalog.items[name]["cost"] for name in self.item_names])
+        self.chances = np.array([bond.chances for bond in self.bonds])
+        self.worth = np.array([bond.worth for bond in self.bonds])
+        # bonds anyone can try, the rest need their item, which is its column in owned or -1 if the store doesn't sell it
+        self.bond_free = np.array([not bond.item for bond in self.bonds], dtype=bool)
+        self.bond_item = np.array([self.item_names.index(bond.item) if bond.item in self.item_names else -1 for bond in self.bonds], dtype=np.int64)
+        self.bond_sold = self.bond_item >= 0
+        self.menus = {}
+
+    def menu(self, season):
+        '''
+        (affection, bond, cost) arrays for the season's paid foods, the free cracker is handled on its own.
+        '''
+        if season not in self.menus:
+            foods = [food for name, food in self.catalog.foods[season].items() if name != "cracker"]
+            self.menus[season] = (
+                np.array([food["affection"] for food in foods]),
+                np.array([food.get("bond", 0) for food in foods]),
+                np.array([food["cost"] for food in foods]),
+            )
+        return self.menus[season]
+
+def simulate(params, store, bond_data):
+    '''
+    Run one simulation and return its report as a dict.
+    '''
+    started = time.monotonic()
+    rng = np.random.default_rng(params["seed"])
+    economy = Economy(store, bond_data)
+    n = params["viewers"]
+    top = params["top"]
+
+    # who the viewers are
+    activity = rng.beta(2, 2 / params["activity"] - 2, n)
+    income = params["sp_per_day"] * rng.lognormal(-0.125, 0.5, n)
+
+    # their rows in the users table, plus the SP StreamElements holds for them
+    affection = np.zeros(n, dtype=np.int64)
+    bond_level = np.zeros(n, dtype=np.int64)
+    owned = np.zeros((n, len(economy.item_names)), dtype=bool)
+    sp = np.zeros(n, dtype=np.int64)
+
+    earned = 0
+    sinks = {"food": 0, "items": 0, "gifts": 0}
+    attempts = np.zeros(len(economy.bonds), dtype=np.int64)
+    successes = np.zeros(len(economy.bonds), dtype=np.int64)
+    puzzle_rewards = np.zeros(3, dtype=np.int64)
+    happiness = []
+    churn = []
+    leader_changes = 0
+    previous_top = None
+    cracker = store.get("base", {}).get("cracker", {"affection": 0})["affection"]
+    puzzle = economy.catalog.gifts.get("puzzle")
+
+    day = datetime.date.fromisoformat(params["start"])
+    for day_number in range(params["days"]):
+        food_affection, food_bond, food_cost = economy.menu(StoreHandler.season_of(day.month))
+        active = np.flatnonzero(rng.random(n) < activity)
+
+        # watching earns SP
+        gain = rng.poisson(income[active])
+        sp[active] += gain
+        earned += int(gain.sum())
+
+        # everyone in chat takes the free cracker, which counts as feeding but gives no bond attempt
+        fed = np.zeros(n, dtype=bool)
+        fed[active] = True
+        add_affection(affection, active, cracker)
+
+        # paid feeds, a random food from the season's menu each time, skipped if they can't afford it
+        bonds_available = np.zeros(n, dtype=np.int64)
+        wanted = rng.poisson(params["feeds_per_day"], len(active))
+        for round_ in range(int(wanted.max(initial=0))):
+            who = active[wanted > round_]
+            pick = rng.integers(0, len(food_cost), len(who))
+            ok = sp[who] >= food_cost[pick]
+            who, pick = who[ok], pick[ok]
+            sp[who] -= food_cost[pick]
+            sinks["food"] += int(food_cost[pick].sum())
+            add_affection(affection, who, food_affection[pick])
+            bond_level[who] += food_bond[pick]
+            bonds_available[who] += 1
+
+        # bond items, a random one that isn't owned yet
+        if len(economy.item_names):
+            who = active[rng.random(len(active)) < params["buy_rate"]]
+            pick = rng.integers(0, len(economy.item_names), len(who))
+            ok = ~owned[who, pick] & (sp[who] >= economy.item_costs[pick])
+            who, pick = who[ok], pick[ok]
+            owned[who, pick] = True
+            sp[who] -= economy.item_costs[pick]
+            sinks["items"] += int(economy.item_costs[pick].sum())
+
+        # puzzles
+        if puzzle is not None:
+            who = active[rng.random(len(active)) < params["gift_rate"]]
+            who = who[sp[who] >= puzzle["cost"]]
+            sp[who] -= puzzle["cost"]
+            sinks["gifts"] += puzzle["cost"] * len(who)
+            reward, kind = gamble_puzzles(puzzle["reward"], len(who), rng)
+            add_affection(affection, who, reward)
+            puzzle_rewards += np.bincount(kind, minlength=3)
+
+        # every bond attempt is used on a random bond the viewer has the item for, without one it goes unused
+        while True:
+            who = np.flatnonzero(bonds_available)
+            if not len(who):
+                break
+            usable = np.tile(economy.bond_free, (len(who), 1))
+            usable[:, economy.bond_sold] = owned[who][:, economy.bond_item[economy.bond_sold]]
+            stuck = ~usable.any(axis=1)
+            bonds_available[who[stuck]] = 0
+            who, usable = who[~stuck], usable[~stuck]
+            if not len(who):
+                break
+            pick = np.argmax(rng.random((len(who), len(economy.bonds))) * usable, axis=1)
+            success = roll_bonds(economy.chances, pick, affection[who], rng)
+            bond_level[who] += np.where(success, economy.worth[pick], 0)
+            bonds_available[who] -= 1
+            attempts += np.bincount(pick, minlength=len(economy.bonds))
+            successes += np.bincount(pick[success], minlength=len(economy.bonds))
+
+        # the nightly job: happiness from today's bond levels, then the leaderboard as it stands, then decay
+        happiness.append(int(np.minimum(bond_level, 100).sum()))
+        leaders = np.lexsort((np.arange(n), -bond_level))[:top]
+        if previous_top is not None:
+            churn.append(len(np.setdiff1d(leaders, previous_top)) / top)
+            leader_changes += int(leaders[0] != previous_top[0])
+        previous_top = leaders
+        if day_number < params["days"] - 1:
+            # the last night isn't decayed, the report is how things stand at the end of the last day
+            affection = decay_day(affection, fed)
+            bond_level = decay_day(bond_level, fed)
+        day += datetime.timedelta(days=1)
+
+    spent = sum(sinks.values())
+    return {
+        "affection": {
+            "mean": float(affection.mean()),
+            "percentiles": dict(zip(PERCENTILES, np.percentile(affection, PERCENTILES).tolist())),
+            "at_max": float((affection >= 100).mean()),
+        },
+        "bond_level": {
+            "mean": float(bond_level.mean()),
+            "percentiles": dict(zip(PERCENTILES, np.percentile(bond_level, PERCENTILES).tolist())),
+            "above_zero": float((bond_level > 0).mean()),
+        },
+        "bonds": {
+            bond.name: {"attempts": int(attempts[i]), "success_rate": float(successes[i] / attempts[i]) if attempts[i] else 0.0}
+            for i, bond in enumerate(economy.bonds)
+        },
+        "leaderboard": {
+            "daily_churn": float(np.mean(churn)) if churn else 0.0,
+            "leader_changes": leader_changes,
+        },
+        "sp": {
+            "earned": earned,
+            "spent": spent,
+            "sinks": {name: amount / spent if spent else 0.0 for name, amount in sinks.items()},
+            "unspent": int(sp.sum()),
+        },
+        "puzzles": dict(zip(GIFT_REWARDS, puzzle_rewards.tolist())),
+        "happiness": {"final": happiness[-1] if happiness else 0, "mean": float(np.mean(happiness)) if happiness else 0.0},
+        "seconds": time.monotonic() - started,
+    }
+
+def run_one(job):
+    '''
+    Process pool entry point, job is (overrides, params, store, bonds).
+    '''
+    overrides, params, store, bond_data = job
+    params, store, bond_data = dict(params), copy.deepcopy(store), copy.deepcopy(bond_data)
+    for key, value in overrides:
+        apply_override(params, store, bond_data, key, value)
+    return overrides, simulate(params, store, bond_data)
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def parse_sweep(spec):
+    '''
+    "key=1,2,3" -> [(key, 1), (key, 2), (key, 3)]
+    '''
+    key, _, values = spec.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"{spec} should look like key=value,value")
+    return [(key, parse_value(value)) for value in values.split(",")]
+
+def describe(overrides, report):
+    '''
+    One run's report as a few readable lines.
+    '''
+    name = ", ".join(f"{key}={value}" for key, value in overrides) or "baseline"
+    aff, bond, sp = report["affection"], report["bond_level"], report["sp"]
+    lines = [
+        f"== {name} ({report['seconds']:.1f}s)",
+        f"affection  mean {aff['mean']:.1f}  p10/50/90/99 {'/'.join(f'{v:g}' for v in aff['percentiles'].values())}  at 100 {aff['at_max']:.1%}",
+        f"bond level mean {bond['mean']:.1f}  p10/50/90/99 {'/'.join(f'{v:g}' for v in bond['percentiles'].values())}  above 0 {bond['above_zero']:.1%}",
+        f"leaderboard daily churn {report['leaderboard']['daily_churn']:.1%}  leader changes {report['leaderboard']['leader_changes']}",
+        f"SP earned {sp['earned']}  spent {sp['spent']} ({', '.join(f'{k} {v:.0%}' for k, v in sp['sinks'].items())})  unspent {sp['unspent']}",
+        f"happiness final {report['happiness']['final']}  mean {report['happiness']['mean']:.0f}",
+        "bonds " + "  ".join(f"{name} {b['attempts']}@{b['success_rate']:.0%}" for name, b in report["bonds"].items()),
+    ]
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the FeedBrie economy.")
+    for key, value in DEFAULT_PARAMS.items():
+        parser.add_argument(f"--{key}", type=type(value), default=value)
+    parser.add_argument("--store", default="store.json")
+    parser.add_argument("--bonds", default="bonds.json")
+    parser.add_argument("--sweep", type=parse_sweep, action="append", default=[],
+                        help="key=value,value to try, may be given more than once")
+    parser.add_argument("--workers", type=int, default=None, help="processes for a sweep, defaults to the CPU count")
+    parser.add_argument("--json", help="also write every report to this file")
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in DEFAULT_PARAMS}
+    store, bond_data = load_json(args.store), load_json(args.bonds)
+    jobs = [(combination, params, store, bond_data) for combination in itertools.product(*args.sweep)]
+
+    if len(jobs) == 1:
+        results = [run_one(jobs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(run_one, jobs))
+
+    for overrides, report in results:
+        print(describe(overrides, report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{"overrides": dict(overrides), "report": report} for overrides, report in results], f, indent=2)
+
+if __name__ == "__main__":
+    main()
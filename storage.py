@@ -0,0 +1,603 @@
+import abc
+import asyncio
+import collections
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from usercache import USER_COLUMNS
+import decay
+
+try:
+    import MySQLdb as mariadb
+    from MySQLdb.constants import CLIENT
+except ImportError:
+    # Only needed for the MariaDB backend
+    mariadb = None
+
+log = logging.getLogger("chatbot")
+
+# Connection pool tuning
+POOL_SIZE = 5                   # max number of open connections (and worker threads)
+POOL_ACQUIRE_TIMEOUT = 10.0     # seconds to wait for a free connection before giving up
+POOL_HEALTH_CHECK_INTERVAL = 60.0   # idle connections older than this get pinged before reuse
+
+class PoolTimeoutException(Exception):
+    def __init__(self, timeout):
+        self.message = f"Timed out after {timeout} seconds waiting for a free database connection."
+
+# Everything a backend may raise on a failed query
+STORAGE_ERRORS = (sqlite3.Error, PoolTimeoutException) + ((mariadb.Error,) if mariadb is not None else ())
+
+class StorageBackend(abc.ABC):
+    '''
+    Everything Database needs from the place the users table lives.
+    Row tuples are always in usercache.USER_COLUMNS order.
+    Every method is abstract, so a backend missing one fails when it's created instead of in the middle of a job.
+    '''
+
+    @abc.abstractmethod
+    def open(self):
+        '''
+        Connect, make sure the users table is usable, and return its column names.
+        Called once at startup, before the event loop is running.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def load_user(self, user_id):
+        '''
+        Returns a user's whole row, or None if they have none.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def write_users(self, batch):
+        '''
+        Write a batch of [(user_id, {column: value})] in one transaction.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def create_user(self, user_id, username, now):
+        '''
+        Add a users row unless one already exists. Returns True if it was added.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_values(self, user_id, columns):
+        '''
+        Returns a tuple of the given columns for a user, or None if they have no row.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_user(self, user_id, deltas, sets, caps, where):
+        '''
+        Single guarded UPDATE, see Database.apply_deltas. Returns True if the row matched.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def catch_up_decay(self, user_id):
+        '''
+        Apply any decay a user's row is owed, see decay.py.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_column(self, column):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_top_rows(self, column, order_column, limit, exclude_id=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_leaderboard_rows(self, lazy):
+        '''
+        Returns (user_id, username, bond_level) for every user.
+        With lazy set, bond_level is read as if the row was caught up on decay.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def calc_happiness(self, brie_id, lazy):
+        '''
+        Set Brie's bond_level to the sum of everyone else's (capped at 100 each).
+        Returns (old happiness, new happiness).
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def next_chunk(self, after_id, chunk_size):
+        '''
+        Returns the last user_id of the next chunk_size users after after_id in user_id order, or None once the table is done.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def decay_chunk(self, after_id, last_id, cutoff, exclude_id):
+        '''
+        Run the nightly decay on the users after after_id up to and including last_id. Returns the rows matched.
+        '''
+        raise NotImplementedError
+
+class SQLBackend(StorageBackend):
+    '''
+    The users table operations in SQL, shared by every SQL engine.
+    Subclasses provide query/execute/execute_many and the few spots where the dialects differ.
+    '''
+    param = "%s"
+    today = "CURDATE()"
+    insert_ignore = "INSERT IGNORE"
+    fed_on_create = False   # True where the table has no default for last_fed_brie_timestamp
+
+    def least(self, *args):
+        return f"LEAST({', '.join(args)})"
+
+    def greatest(self, *args):
+        return f"GREATEST({', '.join(args)})"
+
+    def days_between(self, later, earlier):
+        return f"DATEDIFF({later}, {earlier})"
+
+    def date_of(self, expr):
+        return f"DATE({expr})"
+
+    def int_div(self, numerator, denominator):
+        return f"FLOOR(({numerator}) / {denominator})"
+
+    @abc.abstractmethod
+    async def query(self, sql, params=None):
+        '''
+        Run a SELECT and return every row as a tuple.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def execute(self, sql, params=None):
+        '''
+        Run a statement that doesn't return rows and give back the affected row count.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def execute_many(self, statements):
+        '''
+        Run a list of (sql, params) statements in one transaction.
+        '''
+        raise NotImplementedError
+
+    async def load_user(self, user_id):
+        p = self.param
+        res = await self.query(f"SELECT {','.join(USER_COLUMNS)} FROM users WHERE user_id = {p}", (user_id,))
+        return res[0] if res else None
+
+    async def write_users(self, batch):
+        p = self.param
+        statements = []
+        for user_id, changes in batch:
+            fields = sorted(changes)
+            sql = f"UPDATE users SET {','.join(f'{field} = {p}' for field in fields)} WHERE user_id = {p}"
+            statements.append((sql, tuple(changes[field] for field in fields) + (user_id,)))
+        await self.execute_many(statements)
+
+    async def create_user(self, user_id, username, now):
+        # By not updating last_fed_brie_timestamp it inherits the default value defined by the table schema.
+        p = self.param
+        columns = "username,user_id,affection,bond_level,bonds_available,has_feather,has_brush,has_scratcher,free_feed,created_at,updated_at"
+        values = (username,user_id,0,0,0,0,0,0,0,now,now)
+        if self.fed_on_create:
+            columns += ",last_fed_brie_timestamp"
+            values += (now,)
+        # one indexed statement whether or not the user is new, an existing row is left alone
+        return bool(await self.execute(
+            f"{self.insert_ignore} INTO users ({columns}) VALUES ({','.join([p] * len(values))})",
+            values
+        ))
+
+    async def get_values(self, user_id, columns):
+        p = self.param
+        res = await self.query(f"SELECT {','.join(columns)} FROM users WHERE user_id = {p}", (user_id,))
+        return res[0] if res else None
+
+    async def update_user(self, user_id, deltas, sets, caps, where):
+        p = self.param
+        assignments = []
+        params = []
+        for column, delta in deltas.items():
+            if column in caps:
+                assignments.append(f"{column} = {self.least(p, f'{column} + {p}')}")
+                params.extend((caps[column], delta))
+            else:
+                assignments.append(f"{column} = {column} + {p}")
+                params.append(delta)
+        for column, value in sets.items():
+            assignments.append(f"{column} = {p}")
+            params.append(value)
+        conditions = [f"user_id = {p}"]
+        params.append(user_id)
+        for column, (op, value) in where.items():
+            conditions.append(f"{column} {op} {p}")
+            params.append(value)
+
+        updated = await self.execute(f"UPDATE users SET {','.join(assignments)} WHERE {' AND '.join(conditions)}", tuple(params))
+        return updated > 0
+
+    async def catch_up_decay(self, user_id):
+        p = self.param
+        await self.execute(
+            f"UPDATE users SET {decay.sql_catch_up_assignments(self)} WHERE user_id = {p} AND (decayed_through IS NULL OR decayed_through < {self.today})",
+            (user_id,)
+        )
+
+    async def get_column(self, column):
+        res = await self.query(f"SELECT {column} FROM users")
+        return [data[0] for data in res]
+
+    async def get_top_rows(self, column, order_column, limit, exclude_id=None):
+        p = self.param
+        if exclude_id is None:
+            res = await self.query(f"SELECT {column} FROM users ORDER BY {order_column} DESC LIMIT {p}", (limit,))
+        else:
+            res = await self.query(f"SELECT {column} FROM users WHERE user_id != {p} ORDER BY {order_column} DESC LIMIT {p}", (exclude_id, limit))
+        return [data[0] for data in res]
+
+    async def get_leaderboard_rows(self, lazy):
+        bond_level = decay.sql_decayed("bond_level", self) if lazy else "bond_level"
+        return await self.query(f"SELECT user_id, username, {bond_level} FROM users")
+
+    async def calc_happiness(self, brie_id, lazy):
+        p = self.param
+        bond_level = decay.sql_decayed("bond_level", self) if lazy else "bond_level"
+        res = await self.query(
+            f"SELECT (SELECT bond_level FROM users WHERE user_id = {p}), COALESCE(SUM({self.least(bond_level, '100')}), 0) FROM users WHERE user_id != {p}",
+            (brie_id, brie_id)
+        )
+        old_happiness, happiness = res[0][0], int(res[0][1])
+        await self.execute(f"UPDATE users SET bond_level = {p} WHERE user_id = {p}", (happiness, brie_id))
+        return old_happiness, happiness
+
+    async def next_chunk(self, after_id, chunk_size):
+        p = self.param
+        if after_id is None:
+            res = await self.query(f"SELECT MAX(user_id) FROM (SELECT user_id FROM users ORDER BY user_id LIMIT {p}) AS chunk", (chunk_size,))
+        else:
+            res = await self.query(f"SELECT MAX(user_id) FROM (SELECT user_id FROM users WHERE user_id > {p} ORDER BY user_id LIMIT {p}) AS chunk", (after_id, chunk_size))
+        return res[0][0]
+
+    async def decay_chunk(self, after_id, last_id, cutoff, exclude_id):
+        p = self.param
+        # every chunk judges feeding against the same cutoff: one day before the job started
+        assignments = f"""
+            free_feed = 0,
+            bonds_available = 0,
+            affection =
+                CASE
+                    WHEN last_fed_brie_timestamp <= {p} AND affection > 5 THEN affection - 5
+                    WHEN last_fed_brie_timestamp >= {p} AND affection > 1 THEN affection - 1
+                    WHEN affection <= 0 THEN 0
+                    ELSE affection
+                END,
+            bond_level =
+                CASE
+                    WHEN last_fed_brie_timestamp <= {p} AND bond_level > 5 THEN bond_level - 5
+                    WHEN last_fed_brie_timestamp >= {p} AND bond_level > 1 THEN bond_level - 1
+                    WHEN bond_level <= 0 THEN 0
+                    ELSE bond_level
+                END,
+            decayed_through = {self.today}
+            """
+        params = [cutoff] * 4 + [last_id, exclude_id]
+        conditions = f"user_id <= {p} AND user_id != {p}"
+        if after_id is not None:
+            conditions += f" AND user_id > {p}"
+            params.append(after_id)
+        return await self.execute(f"UPDATE users SET {assignments} WHERE {conditions}", tuple(params))
+
+class ConnectionPool:
+    '''
+    A bounded pool of MariaDB connections.
+    MySQLdb is a blocking driver, so every query runs on a worker thread
+    and the event loop only awaits the result.
+    Dead connections are detected here (ping on reuse, discard on OperationalError)
+    so the rest of the code never has to reconnect by hand.
+    '''
+    def __init__(self, connect_func, size=POOL_SIZE, acquire_timeout=POOL_ACQUIRE_TIMEOUT, health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        self.connect_func = connect_func
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+        # idle connections as (connection, time it was last released)
+        self._idle = collections.deque()
+        # created on first use so it binds to the loop that is actually running
+        self._slots = None
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.ping()
+            return True
+        except mariadb.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except mariadb.Error:
+            pass
+
+    async def acquire(self):
+        '''
+        Wait for a free slot and hand out a healthy connection.
+        Connections idle for longer than the health check interval get pinged first.
+        '''
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutException(self.acquire_timeout)
+
+        loop = asyncio.get_event_loop()
+        try:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if time.monotonic() - last_used < self.health_check_interval:
+                    return conn
+                if await loop.run_in_executor(self.executor, self._is_alive, conn):
+                    return conn
+                log.info("Dropping a dead pooled database connection.")
+                self._close(conn)
+            return await loop.run_in_executor(self.executor, self.connect_func)
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        '''
+        Give a connection back to the pool, or throw it away if it is broken.
+        '''
+        if discard:
+            self._close(conn)
+        else:
+            self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    async def run(self, func, *args):
+        '''
+        Run func(connection, *args) on a pooled connection in a worker thread.
+        If the connection died underneath us it is discarded and the call is retried once.
+        '''
+        loop = asyncio.get_event_loop()
+        for attempt in range(2):
+            conn = await self.acquire()
+            future = loop.run_in_executor(self.executor, func, conn, *args)
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the thread still owns the connection, hand it back once it is done
+                future.add_done_callback(lambda f, conn=conn: self.release(conn))
+                raise
+            except mariadb.OperationalError:
+                self.release(conn, discard=True)
+                if attempt > 0:
+                    raise
+                log.warning("Lost a database connection mid-query. Retrying on a fresh one.")
+                continue
+            except:
+                self.release(conn)
+                raise
+            self.release(conn)
+            return result
+
+    def close(self):
+        '''
+        Close every idle connection and stop the worker threads.
+        '''
+        while self._idle:
+            conn, _ = self._idle.pop()
+            self._close(conn)
+        self.executor.shutdown(wait=False)
+
+def _run_query(conn, sql, params):
+    # Runs on a worker thread
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+def _run_execute(conn, sql, params):
+    # Runs on a worker thread
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+def _run_many(conn, statements):
+    # Runs on a worker thread
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        for sql, params in statements:
+            cursor.execute(sql, params)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+class MariaDBBackend(SQLBackend):
+    '''
+    The users table on a MariaDB server, through a pool of MySQLdb connections.
+    '''
+    def __init__(self, host, user, password, database, pool_size=POOL_SIZE):
+        if mariadb is None:
+            raise RuntimeError("The MariaDB backend needs the mysqlclient package installed.")
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        self.pool = ConnectionPool(self.connect, size=pool_size)
+
+    def connect(self):
+        try:
+            # FOUND_ROWS makes UPDATE row counts mean "matched" instead of "changed", which guarded updates rely on
+            return mariadb.connect(host=self.host, user=self.user, password=self.password, db=self.database, autocommit=True, client_flag=CLIENT.FOUND_ROWS)
+        except mariadb.Error as error:
+            log.error(f"Failed to connect to the MariaDB server: {error}")
+            raise
+
+    def open(self):
+        # Runs before any event loop exists, so it uses its own short-lived connection
+        try:
+            conn = self.connect()
+            try:
+                # decay bookkeeping column, added in place on databases that predate it
+                _run_execute(conn, "ALTER TABLE users ADD COLUMN IF NOT EXISTS decayed_through DATE NULL", None)
+                res = _run_query(conn, "SHOW COLUMNS FROM users", None)
+            finally:
+                conn.close()
+            return [field[0] for field in res]
+        except mariadb.Error as error:
+            log.error(f"Failed to get table columns: {error}")
+            raise
+
+    def close(self):
+        self.pool.close()
+
+    async def query(self, sql, params=None):
+        return await self.pool.run(_run_query, sql, params)
+
+    async def execute(self, sql, params=None):
+        return await self.pool.run(_run_execute, sql, params)
+
+    async def execute_many(self, statements):
+        return await self.pool.run(_run_many, statements)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    affection INTEGER NOT NULL DEFAULT 0,
+    bond_level INTEGER NOT NULL DEFAULT 0,
+    bonds_available INTEGER NOT NULL DEFAULT 0,
+    has_feather INTEGER NOT NULL DEFAULT 0,
+    has_brush INTEGER NOT NULL DEFAULT 0,
+    has_scratcher INTEGER NOT NULL DEFAULT 0,
+    free_feed INTEGER NOT NULL DEFAULT 0,
+    last_fed_brie_timestamp TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    decayed_through DATE
+)
+"""
+
+class SQLiteBackend(SQLBackend):
+    '''
+    The users table in an embedded SQLite file, for small channels and for running without a database server.
+    The database runs in WAL mode. Its one connection lives on a single worker thread,
+    so statements are serialized and never block the event loop.
+    '''
+    param = "?"
+    today = "date('now', 'localtime')"
+    insert_ignore = "INSERT OR IGNORE"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def least(self, *args):
+        return f"MIN({', '.join(args)})"
+
+    def greatest(self, *args):
+        return f"MAX({', '.join(args)})"
+
+    def days_between(self, later, earlier):
+        return f"CAST(julianday({later}) - julianday({earlier}) AS INTEGER)"
+
+    def date_of(self, expr):
+        return f"date({expr})"
+
+    def int_div(self, numerator, denominator):
+        # both sides are integers, so SQLite already divides without a remainder
+        return f"(({numerator}) / {denominator})"
+
+    def _open(self):
+        # autocommit, transactions are opened explicitly in _execute_many
+        self.conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SQLITE_SCHEMA)
+        columns = {row[1]: row[4] for row in self.conn.execute("PRAGMA table_info(users)")}
+        fields = list(columns)
+        if columns.get("last_fed_brie_timestamp") is None:
+            # a table made before last_fed_brie_timestamp had a default, SQLite can't add one to an existing column,
+            # so new users are given it on insert and the never fed users so far get the value the default would have given them
+            self.fed_on_create = True
+            self.conn.execute("UPDATE users SET last_fed_brie_timestamp = COALESCE(created_at, datetime('now', 'localtime')) WHERE last_fed_brie_timestamp IS NULL")
+        if "decayed_through" not in fields:
+            self.conn.execute("ALTER TABLE users ADD COLUMN decayed_through DATE")
+            fields.append("decayed_through")
+        return fields
+
+    def open(self):
+        # the connection is created on the worker thread and only ever used there
+        return self.executor.submit(self._open).result()
+
+    def close(self):
+        def _close():
+            if self.conn is not None:
+                self.conn.close()
+        self.executor.submit(_close).result()
+        self.executor.shutdown(wait=False)
+
+    def _query(self, sql, params):
+        return self.conn.execute(sql, params or ()).fetchall()
+
+    def _execute(self, sql, params):
+        return self.conn.execute(sql, params or ()).rowcount
+
+    def _execute_many(self, statements):
+        self.conn.execute("BEGIN")
+        try:
+            for sql, params in statements:
+                self.conn.execute(sql, params or ())
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    async def query(self, sql, params=None):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._query, sql, params)
+
+    async def execute(self, sql, params=None):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._execute, sql, params)
+
+    async def execute_many(self, statements):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._execute_many, statements)
+
+def create_backend(config):
+    '''
+    Build the storage backend named in the [Database] section of the config.
+    '''
+    if config.DB_BACKEND == "sqlite":
+        return SQLiteBackend(config.DB_SQLITE_PATH)
+    if config.DB_BACKEND == "mariadb":
+        return MariaDBBackend(config.DB_HOST, config.DB_USER, config.DB_PASSWORD, config.DB_NAME)
+    raise ValueError(f"Unknown database backend: {config.DB_BACKEND}")
@@ -1,14 +1,13 @@
 import json
 import logging
+import os
+import time
 import random
 import datetime
 from db import Database as db
 
+# store.log is attached by chatbot.py, so importing the store (e.g. from simulate.py) doesn't create it
 log = logging.getLogger("storefront")
-epicfilehandler = logging.FileHandler("store.log")
-epicfilehandler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-log.setLevel(logging.DEBUG)
-log.addHandler(epicfilehandler)
 
 class NotEnoughSPError(Exception):
     def __init__(self):
@@ -30,27 +29,80 @@ class AlreadyOwnedError(Exception):
     def __init__(self):
         self.message = "You already own that item."
 
+class StoreFileError(Exception):
+    def __init__(self, path, problem):
+        self.message = f"Failed to load {path}: {problem}"
+
+SEASONS = ("spring", "summer", "fall", "winter")
+STORE_CHECK_INTERVAL = 5    # seconds between looks at store.json's modified time
+PUZZLE_ODDS = (60, 30)      # percent chance of a common and uncommon puzzle reward, the rest are rare
+
 class StoreLoader:
     @staticmethod
     def load_store(path="store.json"):
         '''
-        Load store from a JSON file
+        Load store from a JSON file. Raises StoreFileError if it can't be read or isn't an object.
         '''
-        data = {}
         try:
             with open(path) as f:
                 data = json.load(f)
-        except:
-            log.exception("Failed to load Bonds JSON.")
+        except (OSError, ValueError) as e:
+            raise StoreFileError(path, e)
+        if not isinstance(data, dict):
+            raise StoreFileError(path, "the store has to be an object")
         return data
 
+class StoreCatalog:
+    '''
+    store.json compiled into the lookups the store needs, so each one is a single dict hit.
+    foods holds the full food menu (base plus that season's foods) for every season,
+    index maps every item in the file to (section, seasons it can be fed in).
+    '''
+    __slots__ = ("foods", "index", "items", "gifts", "mtime")
+
+    def __init__(self, data, mtime=None):
+        base = data.get("base", {})
+        self.foods = {season: {**base, **data.get(season, {})} for season in SEASONS}
+        self.index = {}
+        for section, entries in data.items():
+            if section == "base":
+                seasons = SEASONS
+            elif section in SEASONS:
+                seasons = (section,)
+            else:
+                seasons = ()
+            for item in entries:
+                self.index[item] = (section, seasons)
+        self.items = data.get("items", {})
+        self.gifts = data.get("gifts", {})
+        self.mtime = mtime
+
+    @staticmethod
+    def load(path="store.json"):
+        '''
+        Raises StoreFileError like StoreLoader.load_store.
+        '''
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        return StoreCatalog(StoreLoader.load_store(path), mtime)
+
 class StoreHandler:
 
-    store_list = StoreLoader.load_store()
+    path = "store.json"
+    catalog = StoreCatalog.load(path)
+    next_check = 0.0
 
     @staticmethod
     def __get_season():
-        thisMonth = datetime.datetime.now().month
+        return StoreHandler.season_of(datetime.datetime.now().month)
+
+    @staticmethod
+    def season_of(thisMonth):
+        '''
+        The store season for a month from 1 to 12
+        '''
         if 3 <= thisMonth <= 5:
             return "spring"
         elif 6 <= thisMonth <= 8:
@@ -58,28 +110,67 @@ class StoreHandler:
         elif 9 <= thisMonth <= 11:
             return "fall"
         return "winter"
-    
+
     @staticmethod
     def reload_store(path="store.json"):
         '''
-        Reload store from disk
+        Reload store from disk. Returns False and keeps the old store if the file is broken.
         '''
-        StoreHandler.store_list = StoreLoader.load_store(path)
+        try:
+            catalog = StoreCatalog.load(path)
+        except StoreFileError as e:
+            log.error(f"{e.message}, keeping the old store.")
+            return False
+        StoreHandler.path = path
+        StoreHandler.catalog = catalog
         log.info("Reloading store from JSON.")
-    
+        return True
+
+    @staticmethod
+    def current_catalog():
+        '''
+        The catalog to use right now. Every STORE_CHECK_INTERVAL seconds store.json is checked
+        and compiled again if it changed, so price changes don't need a restart.
+        A broken file keeps the old catalog in place.
+        '''
+        now = time.monotonic()
+        if now >= StoreHandler.next_check:
+            StoreHandler.next_check = now + STORE_CHECK_INTERVAL
+            try:
+                mtime = os.stat(StoreHandler.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != StoreHandler.catalog.mtime:
+                try:
+                    # swapped in one assignment, lookups see either the whole old catalog or the whole new one
+                    StoreHandler.catalog = StoreCatalog(StoreLoader.load_store(StoreHandler.path), mtime)
+                    log.info("store.json changed, reloaded the store.")
+                except StoreFileError as e:
+                    log.error(f"store.json changed but {e.message}, keeping the old store.")
+                except:
+                    log.exception("store.json changed but failed to load, keeping the old store.")
+        return StoreHandler.catalog
+
     @staticmethod
-    def gamble_puzzle(item, com, unc):
+    def gamble_puzzle(catalog, item, com, unc):
         '''
         Takes odds for common, uncommon, and rare(implicit) win
-        and outputs appropriate AP to reward
+        and outputs appropriate AP to reward from the given catalog
+        '''
+        reward = catalog.gifts[item]["reward"]
+        kind = StoreHandler.puzzle_reward_type(random.randint(1,100), com, unc)
+        return {"type": kind, "value": reward[kind]}
+
+    @staticmethod
+    def puzzle_reward_type(rand, com, unc):
+        '''
+        The reward type a roll from 1 to 100 wins
         '''
-        reward = StoreHandler.store_list["gifts"][item]["reward"]
-        rand = random.randint(1,100)
         if 0 < rand <= com:
-            return {"type": "common", "value": reward["common"]}
+            return "common"
         elif com < rand <= com + unc:
-            return {"type": "uncommon", "value": reward["uncommon"]}
-        return {"type": "rare", "value": reward["rare"]}
+            return "uncommon"
+        return "rare"
 
     @staticmethod
     async def try_feed(user_id, user_sp, item):
@@ -89,37 +180,30 @@ class StoreHandler:
         updating user db with new affection value, 
         and finally returns cost of food to subtract
         '''
-        season = StoreHandler.__get_season()
-        seasonal_list = {**StoreHandler.store_list["base"], **StoreHandler.store_list[season]}
-        whole_list = {k:v for d_k in StoreHandler.store_list for k, v in StoreHandler.store_list[d_k].items()}
-        try_food = seasonal_list.get(item, None)
-        whole_try = whole_list.get(item, None)
-        if try_food is None and whole_try is None:
+        catalog = StoreHandler.current_catalog()
+        try_food = catalog.foods[StoreHandler.__get_season()].get(item, None)
+        if try_food is None:
+            if item in catalog.index:
+                raise OutOfSeasonError
             raise NoItemError
-        elif try_food is None:
-            raise OutOfSeasonError
         if user_sp < try_food["cost"]:
             raise NotEnoughSPError
-        await db.set_fed_brie_timestamp(user_id)
 
+        # Each branch is a single guarded update, affection is capped at 100 by the update itself
         affection_to_add = try_food["affection"]
         bond_to_add = try_food.get("bond", None)
-        curr_affection = await db.get_value(user_id, "affection")
-        if curr_affection + affection_to_add > 100:
-            affection_to_add = 100 - curr_affection
-        
+        fed_at = {"last_fed_brie_timestamp": datetime.datetime.now().replace(microsecond=0)}
         if item == "cracker":
-            free_feed_used = await db.get_value(user_id, "free_feed")
-            if free_feed_used == 1:
+            fed = await db.apply_deltas(user_id, {"affection": affection_to_add}, sets={"free_feed": 1, **fed_at},
+                                        caps={"affection": 100}, where={"free_feed": ("=", 0)})
+            if not fed:
                 raise FreeFeedUsed
-            await db.set_value(user_id, "free_feed", 1)
-            await db.add_value(user_id, "affection", affection_to_add)
             return 0
         else:
-            await db.add_value(user_id, "bonds_available", 1)
-            await db.add_value(user_id, "affection", affection_to_add)
+            deltas = {"bonds_available": 1, "affection": affection_to_add}
             if bond_to_add is not None:
-                await db.add_value(user_id, "bond_level", bond_to_add)
+                deltas["bond_level"] = bond_to_add
+            await db.apply_deltas(user_id, deltas, sets=fed_at, caps={"affection": 100})
             return try_food["cost"]
 
     @staticmethod
@@ -127,16 +211,15 @@ class StoreHandler:
         '''
         Unlocks a permanent item if the user has enough SP
         '''
-        perma_items = StoreHandler.store_list["items"]
+        perma_items = StoreHandler.current_catalog().items
         try_item = perma_items.get(item, "None")
         if try_item == "None":
             raise NoItemError
         if user_sp < try_item["cost"]:
             raise NotEnoughSPError
-        has_item = await db.get_value(user_id, f"has_{item}")
-        if has_item == 1:
+        bought = await db.apply_deltas(user_id, {}, sets={f"has_{item}": 1}, where={f"has_{item}": ("=", 0)})
+        if not bought:
             raise AlreadyOwnedError
-        await db.set_value(user_id, f"has_{item}", 1)
         return try_item["cost"]
 
     @staticmethod
@@ -146,18 +229,13 @@ class StoreHandler:
         an amount of affection points. Returns the cost 
         and reward type.
         '''
-        gifts = StoreHandler.store_list["gifts"]
-        try_gift = gifts.get(item, "None")
+        catalog = StoreHandler.current_catalog()
+        try_gift = catalog.gifts.get(item, "None")
         if try_gift == "None":
             raise NoItemError
         if user_sp < try_gift["cost"]:
             raise NotEnoughSPError
         
-        reward = StoreHandler.gamble_puzzle(item, 60, 30)
-        affection_to_add = reward["value"]
-        curr_affection = await db.get_value(user_id, "affection")
-        if curr_affection + affection_to_add > 100:
-            affection_to_add = 100 - curr_affection
-        
-        await db.add_value(user_id, "affection", affection_to_add)
+        reward = StoreHandler.gamble_puzzle(catalog, item, *PUZZLE_ODDS)
+        await db.apply_deltas(user_id, {"affection": reward["value"]}, caps={"affection": 100})
         return {"cost": try_gift["cost"], "reward": reward["type"]}
@@ -1,7 +1,11 @@
+import asyncio
 import aiohttp
 
 # import json
 
+SE_BULK_WINDOW = 0.25       # seconds point changes wait to be sent together in one bulk request
+SE_BULK_MAX_USERS = 100     # a batch this big is sent straight away
+
 class StreamElementsAPI:
     def __init__(self, channel, jwt_id, loop):
         self.channel = channel
@@ -9,19 +13,73 @@ class StreamElementsAPI:
         self.aio_session = None
         self.loop = loop
 
+        self._lookups = {}          # user -> future of a points lookup in progress
+        self._batch = None          # user -> net change waiting for the next bulk request
+        self._batch_done = None     # future resolved once that bulk request is answered
+        self._batch_timer = None
+
         # needs to be done to get the aio_session correctly
         self.loop.create_task(self.set_aio(jwt_id))
 
     async def set_aio(self, jwt_id):
         self.aio_session = aiohttp.ClientSession(headers={"Authorization": "Bearer %s" % jwt_id, "User-Agent": "Brie/0.1 (+https://brie.everything.moe/)"})
 
-    async def get_user_points(self, user):
+    async def _fetch_user_points(self, user):
         async with self.aio_session.get('https://api.streamelements.com/kappa/v2/points/%s/%s' % (self.channel, user)) as response:
             data = await response.json()
             return data['points']
 
+    async def get_user_points(self, user):
+        # concurrent lookups for the same user share one request
+        pending = self._lookups.get(user)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_user_points(user))
+            self._lookups[user] = pending
+            pending.add_done_callback(lambda _: self._lookups.pop(user, None))
+        return await asyncio.shield(pending)
+
     # Append to a user's points, value is an INT, negative will decrease points
     async def set_user_points(self, user, value):
         async with self.aio_session.put('https://api.streamelements.com/kappa/v2/points/%s/%s/%d' % (self.channel, user, value)) as response:
             data = await response.json()
-            return data['newAmount']
\ No newline at end of file
+            return data['newAmount']
+
+    # Append to many users' points in one request, changes is a dict of user -> INT
+    async def update_user_points_bulk(self, changes):
+        body = {"mode": "add", "users": [{"username": user, "current": value} for user, value in changes.items()]}
+        async with self.aio_session.put('https://api.streamelements.com/kappa/v2/points/%s' % self.channel, json=body) as response:
+            response.raise_for_status()
+
+    async def add_user_points(self, user, value):
+        '''
+        Same as set_user_points, but the change waits up to SE_BULK_WINDOW seconds
+        and goes out in one bulk request with every other change made in that time.
+        Changes to the same user are summed. Doesn't return the new amount, the bulk endpoint doesn't report it.
+        '''
+        if self._batch is None:
+            self._batch = {}
+            self._batch_done = self.loop.create_future()
+            self._batch_timer = self.loop.call_later(SE_BULK_WINDOW, self._send_batch)
+        self._batch[user] = self._batch.get(user, 0) + value
+        done = self._batch_done
+        if len(self._batch) >= SE_BULK_MAX_USERS:
+            self._send_batch()
+        await asyncio.shield(done)
+
+    def _send_batch(self):
+        batch, done = self._batch, self._batch_done
+        self._batch = self._batch_done = None
+        self._batch_timer.cancel()
+        self._batch_timer = None
+        self.loop.create_task(self._put_batch(batch, done))
+
+    async def _put_batch(self, batch, done):
+        changes = {user: value for user, value in batch.items() if value}
+        try:
+            if changes:
+                await self.update_user_points_bulk(changes)
+        except Exception as e:
+            done.set_exception(e)
+            done.exception()    # marks it retrieved, every caller may have been cancelled by now
+        else:
+            done.set_result(None)
@@ -0,0 +1,211 @@
+import asyncio
+import datetime as dt
+import json
+import logging
+import random
+import aiohttp
+from helix import PRIORITY_HIGH
+
+log = logging.getLogger("chatbot")
+
+EVENTSUB_WS_URL = "wss://eventsub.wss.twitch.tv/ws"
+EVENTSUB_SUBSCRIPTIONS_URL = "https://api.twitch.tv/helix/eventsub/subscriptions"
+
+PUSH_RETRY_MIN = 30             # seconds before reconnecting after the socket drops, doubled up to PUSH_RETRY_MAX
+PUSH_RETRY_MAX = 30 * 60
+POLL_LIVE = 30                  # seconds between polls while live, to catch the stream ending
+POLL_NEAR_SCHEDULE = 15         # ...while offline close to a usual start time
+POLL_IDLE = 30                  # ...while offline any other time
+POLL_WITH_PUSH = 10 * 60        # ...while push works, only to catch anything it missed
+SCHEDULE_WINDOW = 60 * 60       # seconds either side of a usual start time that count as close
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+class SubscriptionRejectedError(Exception):
+    def __init__(self, event_type, response):
+        self.message = f"Twitch rejected the {event_type} subscription: {response.get('message', response)}"
+
+def parse_schedule(text):
+    '''
+    "Mon 19:00, Thu 18:30" -> [(0, 1140), (3, 1110)], as (weekday, minute of the day).
+    '''
+    starts = []
+    for entry in text.split(","):
+        entry = entry.strip().lower()
+        if not entry:
+            continue
+        try:
+            day, clock = entry.split()
+            hour, minute = clock.split(":")
+            starts.append((DAYS.index(day[:3]), int(hour) * 60 + int(minute)))
+        except ValueError:
+            log.warning(f"Ignoring stream schedule entry {entry!r}, it should look like Mon 19:00.")
+    return starts
+
+class StreamStateService:
+    '''
+    Keeps track of whether the channel is live.
+    stream.online and stream.offline events are pushed over an EventSub WebSocket, and polling
+    only fills in while that isn't working. Polling speeds up around the usual start times
+    from the schedule (and every time the stream was seen going live), and slows down otherwise.
+
+    is_live is a coroutine that asks the api, get_broadcaster_id a coroutine returning the channel's user id,
+    and on_change(live) is called whenever the state flips.
+    The urls can be pointed at eventsub_standin.py for testing.
+
+    Twitch only accepts WebSocket subscriptions made with a user access token, so push needs push_tokens,
+    a TokenManager holding one. Without it, or if twitch turns the subscription down, live status is only polled.
+    '''
+    def __init__(self, helix, is_live, get_broadcaster_id, on_change, schedule=(),
+                 ws_url=EVENTSUB_WS_URL, subscriptions_url=EVENTSUB_SUBSCRIPTIONS_URL, push_tokens=None):
+        self.helix = helix
+        self.push_tokens = push_tokens
+        self.is_live = is_live
+        self.get_broadcaster_id = get_broadcaster_id
+        self.on_change = on_change
+        self.schedule = set(schedule)
+        self.ws_url = ws_url
+        self.subscriptions_url = subscriptions_url
+
+        self.live = False
+        self.push_active = False
+        self._poll_wakeup = None
+        self._tasks = []
+
+    def start(self):
+        self._poll_wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._poll_loop())]
+        if self.push_tokens is None:
+            log.info("No EventSub user token is configured, live status will only be polled.")
+        else:
+            self._tasks.append(asyncio.ensure_future(self._push_loop()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _set_live(self, live, source):
+        if live == self.live:
+            return
+        self.live = live
+        log.info(f"Channel went {'live' if live else 'offline'} ({source}).")
+        if live:
+            now = dt.datetime.now()
+            self.schedule.add((now.weekday(), now.hour * 60 + now.minute))
+        try:
+            self.on_change(live)
+        except:
+            log.exception("Live status change hook failed.")
+
+    def _near_schedule(self, now=None):
+        now = now or dt.datetime.now()
+        minute_of_week = now.weekday() * 1440 + now.hour * 60 + now.minute
+        window = SCHEDULE_WINDOW // 60
+        for day, minute in self.schedule:
+            distance = abs(minute_of_week - (day * 1440 + minute)) % (7 * 1440)
+            if min(distance, 7 * 1440 - distance) <= window:
+                return True
+        return False
+
+    def poll_interval(self):
+        if self.push_active:
+            return POLL_WITH_PUSH
+        if self.live:
+            return POLL_LIVE
+        if self._near_schedule():
+            return POLL_NEAR_SCHEDULE
+        return POLL_IDLE
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                self._set_live(await self.is_live(), "poll")
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("An exception occurred while polling the Live Status.")
+            # woken early when push goes down, so a gap in events is covered straight away
+            self._poll_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._poll_wakeup.wait(), self.poll_interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def _push_loop(self):
+        delay = PUSH_RETRY_MIN
+        url = self.ws_url
+        while True:
+            try:
+                url = await self._listen(url)
+                if url is not None:
+                    # twitch asked us to move to another socket, go right away
+                    continue
+                delay = PUSH_RETRY_MIN
+            except asyncio.CancelledError:
+                raise
+            except SubscriptionRejectedError as e:
+                # retrying won't change the answer, so say it once and leave it to polling
+                log.warning(f"{e.message}. Live status will only be polled.")
+                return
+            except Exception as e:
+                log.warning(f"EventSub push unavailable, polling instead: {e}")
+            finally:
+                if self.push_active:
+                    self.push_active = False
+                    self._poll_wakeup.set()
+            url = self.ws_url
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, PUSH_RETRY_MAX)
+
+    async def _listen(self, url):
+        '''
+        One websocket session. Returns a reconnect url if twitch sends one, None if the socket just closed.
+        '''
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url, heartbeat=None) as ws:
+                keepalive = 30
+                subscribed = url != self.ws_url     # subscriptions carry over to a reconnect url
+                while True:
+                    msg = await ws.receive(timeout=keepalive + 5)
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        log.info(f"EventSub socket closed ({msg.type}).")
+                        return None
+                    data = json.loads(msg.data)
+                    kind = data["metadata"]["message_type"]
+                    payload = data.get("payload", {})
+
+                    if kind == "session_welcome":
+                        keepalive = payload["session"].get("keepalive_timeout_seconds") or keepalive
+                        if not subscribed:
+                            await self._subscribe(payload["session"]["id"])
+                            subscribed = True
+                        self.push_active = True
+                        log.info("Listening for live status changes over EventSub.")
+                    elif kind == "notification":
+                        event_type = payload["subscription"]["type"]
+                        if event_type == "stream.online":
+                            self._set_live(True, "eventsub")
+                        elif event_type == "stream.offline":
+                            self._set_live(False, "eventsub")
+                    elif kind == "session_reconnect":
+                        return payload["session"]["reconnect_url"]
+                    elif kind == "revocation":
+                        log.warning(f"EventSub subscription {payload['subscription']['type']} was revoked.")
+                        return None
+
+    async def _subscribe(self, session_id):
+        broadcaster_id = await self.get_broadcaster_id()
+        for event_type in ("stream.online", "stream.offline"):
+            body = {
+                "type": event_type,
+                "version": "1",
+                "condition": {"broadcaster_user_id": broadcaster_id},
+                "transport": {"method": "websocket", "session_id": session_id}
+            }
+            # a 401 here means the token can't subscribe, refreshing and trying again won't change that
+            response = await self.helix.post(self.subscriptions_url, body, PRIORITY_HIGH, tokens=self.push_tokens, retry_unauthorized=False)
+            if response.get("status") in (400, 401, 403):
+                raise SubscriptionRejectedError(event_type, response)
+            if "data" not in response:
+                raise RuntimeError(f"subscribing to {event_type} failed: {response.get('message', response)}")
@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from content import ContentRegistry
+from cooldowns import CooldownPolicy
+
+class ContentReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bonds_path = os.path.join(self.dir, "bonds.json")
+        self.dialogue_path = os.path.join(self.dir, "dialogue.json")
+        shutil.copy("bonds.json", self.bonds_path)
+        shutil.copy("dialogue.json", self.dialogue_path)
+        self.registry = ContentRegistry(self.bonds_path, self.dialogue_path)
+        self.assertTrue(self.registry.reload())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def edit_bonds(self, edit):
+        with open(self.bonds_path) as f:
+            bonds = json.load(f)
+        edit(bonds)
+        with open(self.bonds_path, "w") as f:
+            json.dump(bonds, f)
+
+    def test_reload_dropping_a_required_bond_is_rejected(self):
+        self.registry.require_bonds(["hug"])
+        before = self.registry.content
+        self.edit_bonds(lambda bonds: bonds.pop("hug"))
+        self.assertFalse(self.registry.reload())
+        self.assertIs(self.registry.content, before)
+        self.assertIn("hug", self.registry.content.bonds)
+
+    def test_broken_edit_is_only_tried_once(self):
+        before = self.registry.content
+        with open(self.bonds_path, "w") as f:
+            f.write("{")
+        os.utime(self.bonds_path, (0, 1))
+        self.registry.next_check = 0.0
+        self.assertIs(self.registry.current(), before)
+        self.assertEqual(self.registry.mtimes[0], 1)
+        attempts = []
+        self.registry.build = lambda: attempts.append(1)
+        self.registry.next_check = 0.0
+        self.assertIs(self.registry.current(), before)
+        self.assertEqual(attempts, [])
+
+    def test_swap_hooks_see_new_cooldowns(self):
+        policies = []
+        self.registry.on_swap(lambda current: policies.append(CooldownPolicy.build([], current.bonds, {})))
+        self.edit_bonds(lambda bonds: bonds["hug"].update(cooldown={"default": 5, "mod": 1}))
+        self.assertTrue(self.registry.reload())
+        self.assertEqual(policies[-1].seconds("hug", "viewer"), 5.0)
+        self.assertEqual(policies[-1].seconds("hug", "mod"), 1.0)
+
+if __name__ == "__main__":
+    unittest.main()
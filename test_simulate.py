@@ -0,0 +1,40 @@
+import json
+import unittest
+
+try:
+    import simulate
+except ImportError:
+    # numpy is only needed by the simulator
+    simulate = None
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+@unittest.skipIf(simulate is None, "numpy isn't installed")
+class SimulateSmokeTest(unittest.TestCase):
+    def setUp(self):
+        self.params = dict(simulate.DEFAULT_PARAMS, viewers=300, days=5)
+        self.store = load("store.json")
+        self.bonds = load("bonds.json")
+
+    def test_runs_on_the_shipped_content(self):
+        report = simulate.simulate(self.params, self.store, self.bonds)
+        self.assertEqual(set(report["bonds"]), set(self.bonds))
+        self.assertGreater(sum(bond["attempts"] for bond in report["bonds"].values()), 0)
+        self.assertLessEqual(report["affection"]["percentiles"][99], 100)
+
+    def test_store_without_items(self):
+        self.store["items"] = {}
+        report = simulate.simulate(self.params, self.store, self.bonds)
+        for name, bond in self.bonds.items():
+            if bond["item"]:
+                self.assertEqual(report["bonds"][name]["attempts"], 0)
+
+    def test_puzzle_odds_follow_the_store(self):
+        reward = {"common": 1, "uncommon": 2, "rare": 3}
+        _, kind = simulate.gamble_puzzles(reward, 10000, simulate.np.random.default_rng(1), odds=(100, 0))
+        self.assertTrue((kind == 0).all())
+
+if __name__ == "__main__":
+    unittest.main()
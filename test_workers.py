@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+from message import MessageContext
+from registry import Command, PRIVILEGE_HOST, PRIVILEGE_MOD
+from workers import CommandPool
+
+async def noop(*args):
+    pass
+
+class PriorityFloodTest(unittest.TestCase):
+    def setUp(self):
+        self.shutdown = Command("shutdown", noop, privilege=PRIVILEGE_HOST)
+        self.toggle = Command("toggleonline", noop, privilege=PRIVILEGE_MOD)
+        self.feed = Command("feed", noop)
+
+    def test_only_host_and_mods_jump_the_queue(self):
+        viewer = MessageContext("viewer", {"user-id": "1"})
+        mod = MessageContext("mod", {"user-id": "2", "mod": "1"})
+        host = MessageContext("host", {"user-id": "3"})
+        self.assertFalse(self.shutdown.jumps_queue(viewer, "host"))
+        self.assertFalse(self.toggle.jumps_queue(viewer, "host"))
+        self.assertTrue(self.toggle.jumps_queue(mod, "host"))
+        self.assertTrue(self.shutdown.jumps_queue(host, "host"))
+        self.assertFalse(self.feed.jumps_queue(mod, "host"))
+
+    def test_unprivileged_flood_is_shed_like_any_command(self):
+        pool = CommandPool(max_queued=5)
+        for i in range(5):
+            pool.submit(f"user{i}", noop)
+        spammer = MessageContext("spammer", {"user-id": "99"})
+        for _ in range(50):
+            pool.submit("99", noop, priority=self.shutdown.jumps_queue(spammer, "host"))
+        self.assertEqual(pool.queued, 5)
+        self.assertEqual(pool.stats()["priority_queued"], 0)
+        self.assertEqual(pool.dropped, 50)
+
+    def test_priority_lane_is_bounded_on_its_own(self):
+        pool = CommandPool(max_queued=5, max_priority=3)
+        for i in range(5):
+            pool.submit(f"user{i}", noop)
+        for _ in range(10):
+            pool.submit("mod", noop, priority=True)
+        self.assertEqual(pool.queued, 5)
+        self.assertEqual(pool.stats()["priority_queued"], 3)
+        self.assertEqual(pool.dropped, 7)
+
+        async def drain():
+            task = asyncio.ensure_future(pool.run())
+            while pool.completed < 8:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(drain())
+        loop.close()
+        self.assertEqual(pool.queued, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import collections
+import time
+
+class TTLCache:
+    '''
+    Small LRU cache whose entries also expire after ttl seconds.
+    A value stored as negative (a lookup that found nothing) expires after negative_ttl instead,
+    so a miss isn't retried on every call but doesn't stick around as long as a real answer.
+    '''
+    def __init__(self, max_size, ttl, negative_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._entries = collections.OrderedDict()   # key -> (expires_at, value), least recently used first
+
+    def get(self, key):
+        '''
+        Returns (found, value). Expired entries count as not found.
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[1]
+
+    def set(self, key, value, negative=False):
+        ttl = self.negative_ttl if negative else self.ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
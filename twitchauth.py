@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from urllib.parse import quote
+
+log = logging.getLogger("chatbot")
+
+TOKEN_REFRESH_MARGIN = 10 * 60     # refresh this many seconds before the token expires
+TOKEN_RETRY_DELAY = 30             # seconds before trying again after a failed refresh, doubled after each failure in a row
+TOKEN_RETRY_MAX_DELAY = 15 * 60    # the longest wait between retries
+
+class TokenManager:
+    '''
+    Keeps an access token for the Twitch API fresh. That's the app access token from client credentials,
+    or with refresh_token a user access token, for the few endpoints an app token isn't allowed to use.
+    The token is refreshed on a timer from expires_in minus TOKEN_REFRESH_MARGIN, and is only
+    validated when a request comes back 401. It's added to each request with headers() so one
+    long-lived session can be kept across token changes.
+
+    session has to be set to the shared aiohttp.ClientSession before refresh() is called.
+    '''
+    def __init__(self, client_id, client_secret, loop, margin=TOKEN_REFRESH_MARGIN, refresh_token=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.loop = loop
+        self.margin = margin
+        self.session = None
+        self.token = ""
+        self.expires_at = 0.0
+        self._refreshing = None     # future of a refresh in progress, shared by everyone who needs one
+        self._timer = None
+        self._retry_delay = TOKEN_RETRY_DELAY
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def get_token(self):
+        '''
+        Returns a token that hasn't expired, refreshing first if it has.
+        '''
+        if not self.token or time.monotonic() >= self.expires_at:
+            await self.refresh()
+        return self.token
+
+    async def refresh(self):
+        '''
+        Get a new token. Callers that arrive while a refresh is running wait for that one.
+        '''
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refresh_done)
+        await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, future):
+        self._refreshing = None
+
+    async def keep_fresh(self):
+        '''
+        Refresh, and if that fails log it and try again later, waiting longer after each failure in a row.
+        The refresh timer runs this, so a failed refresh is always handled.
+        '''
+        try:
+            await self.refresh()
+        except Exception as e:
+            log.error(f"Failed to refresh the Auth Token, trying again in {self._retry_delay} seconds: {e}")
+            self._schedule(self._retry_delay)
+            self._retry_delay = min(self._retry_delay * 2, TOKEN_RETRY_MAX_DELAY)
+
+    async def _refresh(self):
+        # We don't need to specify scopes here at the moment since we aren't modifying anything or reading sensitive info.
+        url = f"https://id.twitch.tv/oauth2/token?client_id={self.client_id}&client_secret={self.client_secret}&grant_type=client_credentials"
+        if self.refresh_token:
+            url = f"https://id.twitch.tv/oauth2/token?client_id={self.client_id}&client_secret={self.client_secret}&grant_type=refresh_token&refresh_token={quote(self.refresh_token)}"
+        async with self.session.post(url) as response:
+            output = await response.json()
+        self.token = output["access_token"]
+        # twitch may hand out a new refresh token with every refresh
+        self.refresh_token = output.get("refresh_token", self.refresh_token)
+        expires_in = int(output["expires_in"])
+        self.expires_at = time.monotonic() + expires_in
+        self._retry_delay = TOKEN_RETRY_DELAY
+        self._schedule(max(expires_in - self.margin, TOKEN_RETRY_DELAY))
+        log.info(f"Refreshed Auth Token. Expire Time: {expires_in}")
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(delay, lambda: asyncio.ensure_future(self.keep_fresh()))
+
+    async def validate(self):
+        '''
+        Just verify that the token we have right now is correct.
+        We have to use "OAuth" instead of "Bearer" and the reason why isn't very clear
+        '''
+        try:
+            async with self.session.get("https://id.twitch.tv/oauth2/validate", headers={"Authorization": f"OAuth {self.token}"}) as response:
+                if response.status != 200:
+                    return False
+                output = await response.json()
+                return int(output["expires_in"]) > 0
+        except:
+            # Probably failed to validate.
+            log.exception(f"There was an exception while validating the Auth Token.")
+            return False
+
+    async def unauthorized(self, token):
+        '''
+        Called when a request made with token got a 401.
+        Refreshes if the token really is dead and nobody has replaced it yet.
+        '''
+        if token != self.token:
+            return
+        if self._refreshing is None and await self.validate():
+            return
+        log.info("It appears the Auth Token failed to validate or is expired. Refreshing.")
+        await self.refresh()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
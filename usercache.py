@@ -0,0 +1,408 @@
+import asyncio
+import collections
+import logging
+import operator
+import time
+from contextlib import asynccontextmanager
+
+log = logging.getLogger("chatbot")
+
+# Columns of the users table that are kept in memory
+USER_COLUMNS = (
+    "username", "user_id", "affection", "bond_level", "bonds_available",
+    "has_feather", "has_brush", "has_scratcher", "free_feed",
+    "last_fed_brie_timestamp", "created_at", "updated_at", "decayed_through"
+)
+
+CACHE_MAX_USERS = 5000          # LRU bound on how many rows are held at once
+CACHE_IDLE_SECONDS = 30 * 60    # rows untouched for this long are dropped on the next flush
+CACHE_FLUSH_INTERVAL = 10       # seconds between write-behind flushes
+
+# Comparisons allowed in guarded updates, by their SQL spelling
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge
+}
+
+class UserState:
+    '''
+    One cached row of the users table.
+    dirty holds the names of the fields changed since the last flush, and base what they were
+    in the database before that, so a row can be rebased if the table is rewritten under it.
+    stale is set when that happened and the row hasn't been rebased yet.
+    '''
+    __slots__ = USER_COLUMNS + ("dirty", "base", "stale", "last_used")
+
+    def __init__(self, row):
+        for field, value in zip(USER_COLUMNS, row):
+            setattr(self, field, value)
+        self.dirty = set()
+        self.base = {}
+        self.stale = False
+        self.last_used = time.monotonic()
+
+    def set(self, field, value):
+        if field not in self.dirty:
+            self.base[field] = getattr(self, field)
+        setattr(self, field, value)
+        self.dirty.add(field)
+
+    def pop_changes(self):
+        '''
+        Returns ({field: value}, {field: base}) for every dirty field and marks the row clean.
+        '''
+        changes = {field: getattr(self, field) for field in self.dirty}
+        base = self.base
+        self.dirty = set()
+        self.base = {}
+        return changes, base
+
+    def restore_changes(self, changes, base):
+        '''
+        Undo pop_changes after a failed write. Fields changed again since keep their new value but get the old base back,
+        since the database still holds that.
+        '''
+        self.dirty.update(changes)
+        self.base.update(base)
+
+    def rebase(self, row):
+        '''
+        Move the row onto a freshly read database row. Numbers that were changed here are
+        carried over as the change made (value - base), so a rewrite such as the nightly decay isn't undone.
+        Anything else that was changed here keeps the value it was set to.
+        '''
+        fresh = dict(zip(USER_COLUMNS, row))
+        for field, value in fresh.items():
+            if field in self.dirty:
+                current = getattr(self, field)
+                base = self.base.get(field)
+                if _is_number(current) and _is_number(base) and _is_number(value):
+                    setattr(self, field, value + current - base)
+                self.base[field] = value
+            else:
+                setattr(self, field, value)
+        self.stale = False
+
+def _is_number(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+class UserCache:
+    '''
+    Write-behind cache of users rows keyed by user_id.
+    Reads are served from memory once a row is loaded, writes only touch memory
+    and are written back in batches by flush().
+
+    load_row is a coroutine taking a user_id and returning a row tuple in USER_COLUMNS order, or None.
+    write_rows is a coroutine taking a list of (user_id, {field: value}) and writing them all.
+    on_change, if given, is called as on_change(user_id, record, fields) after every in-memory change.
+    prepare, if set, is called as prepare(user_id, record) before a row is used and returns the fields it changed.
+    '''
+    def __init__(self, load_row, write_rows, max_users=CACHE_MAX_USERS, idle_seconds=CACHE_IDLE_SECONDS, on_change=None):
+        self.load_row = load_row
+        self.write_rows = write_rows
+        self.on_change = on_change
+        self.prepare = None
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+
+        self._users = collections.OrderedDict()    # least recently used first
+        self._evicted = {}                          # dirty rows pushed out by the LRU, written on the next flush
+        self._loading = {}                          # user_id -> future of a row fetch in progress
+
+        # created on first use so they bind to the loop that is actually running
+        self._open = None           # cleared while exclusive() holds the cache
+        self._drained = None        # set whenever no access is in progress
+        self._released = None       # set whenever an access finishes
+        self._flush_lock = None
+        self._active = 0
+        self._busy = collections.Counter()  # user_id -> accesses in progress
+        self._rewriting = None      # while rewriting() holds some users, picks them out by user_id
+        self._rewrite_done = None
+
+    def _ensure_sync_objects(self):
+        if self._open is None:
+            self._open = asyncio.Event()
+            self._open.set()
+            self._drained = asyncio.Event()
+            self._drained.set()
+            self._released = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def _access(self, user_id):
+        self._ensure_sync_objects()
+        while True:
+            if not self._open.is_set():
+                await self._open.wait()
+            elif self._rewriting is not None and self._rewriting(user_id):
+                await self._rewrite_done.wait()
+            else:
+                break
+        self._active += 1
+        self._busy[user_id] += 1
+        self._drained.clear()
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._busy[user_id] -= 1
+            if not self._busy[user_id]:
+                del self._busy[user_id]
+            if self._active == 0:
+                self._drained.set()
+            self._released.set()
+
+    async def _load(self, user_id):
+        try:
+            row = await self.load_row(user_id)
+            if row is None:
+                return None
+            record = UserState(row)
+            self._users[user_id] = record
+            self._evict_overflow()
+            return record
+        finally:
+            del self._loading[user_id]
+
+    async def _get(self, user_id):
+        record = self._users.get(user_id)
+        if record is None:
+            record = self._evicted.pop(user_id, None)
+            if record is not None and record.stale:
+                try:
+                    record = await self._rebase(user_id, record)
+                except:
+                    self._evicted.setdefault(user_id, record)
+                    raise
+            if record is None:
+                pending = self._loading.get(user_id)
+                if pending is None:
+                    pending = asyncio.ensure_future(self._load(user_id))
+                    self._loading[user_id] = pending
+                # shielded so one cancelled command doesn't cancel the fetch for everyone waiting on it
+                record = await asyncio.shield(pending)
+                if record is None:
+                    return None
+            else:
+                self._users[user_id] = record
+                self._evict_overflow()
+        else:
+            self._users.move_to_end(user_id)
+        record.last_used = time.monotonic()
+        if self.prepare is not None:
+            fields = self.prepare(user_id, record)
+            if fields:
+                self._changed(user_id, record, fields)
+        return record
+
+    async def _rebase(self, user_id, record):
+        '''
+        Re-read a stale row and rebase its unwritten changes onto it. Returns None if the row is gone.
+        '''
+        row = await self.load_row(user_id)
+        if row is None:
+            log.warning(f"Dropped unwritten changes for user_id {user_id}, their row is gone.")
+            return None
+        record.rebase(row)
+        return record
+
+    def _evict(self, user_id):
+        record = self._users.pop(user_id)
+        if record.dirty:
+            self._evicted[user_id] = record
+
+    def _evict_overflow(self):
+        while len(self._users) > self.max_users:
+            self._evict(next(iter(self._users)))
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._users:
+            user_id, record = next(iter(self._users.items()))
+            if record.last_used > cutoff:
+                break
+            self._evict(user_id)
+
+    async def get_value(self, user_id, field):
+        '''
+        Returns (found, value) for one field of a user's row.
+        '''
+        async with self._access(user_id):
+            record = await self._get(user_id)
+            if record is None:
+                return False, None
+            return True, getattr(record, field)
+
+    async def set_value(self, user_id, field, value):
+        '''
+        Set a field in memory. Returns False if the user has no row.
+        '''
+        async with self._access(user_id):
+            record = await self._get(user_id)
+            if record is None:
+                return False
+            record.set(field, value)
+            self._changed(user_id, record, (field,))
+            return True
+
+    async def add_value(self, user_id, field, delta):
+        '''
+        Add to a numeric field in memory. Returns False if the user has no row.
+        '''
+        async with self._access(user_id):
+            record = await self._get(user_id)
+            if record is None:
+                return False
+            record.set(field, getattr(record, field) + delta)
+            self._changed(user_id, record, (field,))
+            return True
+
+    async def get_values(self, user_id, fields):
+        '''
+        Returns a tuple of several fields of a user's row, or None if the user has no row.
+        '''
+        async with self._access(user_id):
+            record = await self._get(user_id)
+            if record is None:
+                return None
+            return tuple(getattr(record, field) for field in fields)
+
+    async def apply(self, user_id, deltas, sets, caps=None, where=None):
+        '''
+        Add each {field: delta} and assign each {field: value} in memory.
+        caps holds {field: max} limits for the deltas and where holds {field: (op, value)}
+        conditions that must all be true for anything to change.
+        The check and the change happen without yielding to the loop, so they are atomic.
+        Returns False if the user has no row or a condition failed.
+        '''
+        async with self._access(user_id):
+            record = await self._get(user_id)
+            if record is None:
+                return False
+            if where:
+                for field, (op, value) in where.items():
+                    if not COMPARISONS[op](getattr(record, field), value):
+                        return False
+            for field, delta in deltas.items():
+                new_value = getattr(record, field) + delta
+                if caps and field in caps:
+                    new_value = min(caps[field], new_value)
+                record.set(field, new_value)
+            for field, value in sets.items():
+                record.set(field, value)
+            self._changed(user_id, record, list(deltas) + list(sets))
+            return True
+
+    def _changed(self, user_id, record, fields):
+        if self.on_change is not None:
+            try:
+                self.on_change(user_id, record, fields)
+            except:
+                log.exception(f"Cache change hook failed for user_id: {user_id}")
+
+    def invalidate(self, user_id):
+        '''
+        Forget a single user. Unflushed changes are kept for the next flush.
+        '''
+        if user_id in self._users:
+            self._evict(user_id)
+
+    async def flush(self):
+        '''
+        Write every changed row back in one batch, then drop rows that have gone idle.
+        Changes that fail to write are kept and retried on the next flush.
+        '''
+        self._ensure_sync_objects()
+        async with self._flush_lock:
+            # evicted rows stay in _evicted until written so a lookup mid-flush still finds them
+            pending = list(self._evicted.items())
+            pending.extend((user_id, record) for user_id, record in self._users.items() if record.dirty)
+
+            if await self._write(pending):
+                self._evict_idle()
+
+    async def _write(self, pending):
+        '''
+        Write the changes of [(user_id, record)] in one batch. Returns False if that failed,
+        in which case the changes stay queued. Stale rows are rebased first, see UserState.rebase.
+        '''
+        if not pending:
+            return True
+        start = time.monotonic()
+        batch = []
+        try:
+            for user_id, record in pending:
+                if record.stale and await self._rebase(user_id, record) is None:
+                    record.dirty = set()
+                    if self._evicted.get(user_id) is record:
+                        del self._evicted[user_id]
+                    continue
+                batch.append((user_id, record) + record.pop_changes())
+            await self.write_rows([(user_id, changes) for user_id, _, changes, _ in batch])
+        except:
+            for user_id, record, changes, base in batch:
+                record.restore_changes(changes, base)
+            log.exception(f"Failed to flush {len(pending)} cached users. Will retry on the next flush.")
+            return False
+        for user_id, record, _, _ in batch:
+            if self._evicted.get(user_id) is record and not record.dirty:
+                del self._evicted[user_id]
+        log.debug(f"Flushed {len(batch)} cached users in {time.monotonic() - start:.3f}s.")
+        return True
+
+    @asynccontextmanager
+    async def rewriting(self, matches):
+        '''
+        Like exclusive(), but only for the users matches(user_id) picks out, everyone else carries on.
+        Their changes are written and their rows dropped before the block runs, and they're held off until it exits.
+        Used by jobs that rewrite the users table one chunk at a time.
+        '''
+        self._ensure_sync_objects()
+        async with self._flush_lock:
+            self._rewriting = matches
+            self._rewrite_done = asyncio.Event()
+            try:
+                while any(matches(user_id) for user_id in self._busy):
+                    self._released.clear()
+                    await self._released.wait()
+                pending = [(user_id, record) for user_id, record in self._evicted.items() if matches(user_id)]
+                pending.extend((user_id, record) for user_id, record in self._users.items() if record.dirty and matches(user_id))
+                await self._write(pending)
+                for user_id in [user_id for user_id in self._users if matches(user_id)]:
+                    self._evict(user_id)
+                # whatever failed to write is rebased once the rewrite is done
+                for user_id, record in self._evicted.items():
+                    if matches(user_id):
+                        record.stale = True
+                yield
+            finally:
+                self._rewriting = None
+                self._rewrite_done.set()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        '''
+        Flush and empty the cache, holding off every other access until the block exits.
+        Used by jobs that rewrite the users table behind the cache's back.
+        '''
+        self._ensure_sync_objects()
+        while not self._open.is_set():
+            await self._open.wait()
+        self._open.clear()
+        try:
+            while self._active:
+                await self._drained.wait()
+            await self.flush()
+            # anything still dirty here failed to write, keep it queued for the next flush.
+            # The block may rewrite those rows, so they're rebased before they're used or written.
+            for user_id in list(self._users):
+                self._evict(user_id)
+            for record in self._evicted.values():
+                record.stale = True
+            yield
+        finally:
+            self._open.set()
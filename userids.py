@@ -0,0 +1,65 @@
+import heapq
+from array import array
+from bisect import bisect_left
+
+USER_ID_MERGE_SIZE = 1024   # new ids collected in a set before they're merged into the array
+
+class UserIdSet:
+    '''
+    Membership set for twitch user ids, which are numeric strings.
+    They're kept as a sorted array of 64 bit integers, about 8 bytes each instead of the ~100
+    a set of strings costs. Lookups are a binary search. New ids wait in a small set and are
+    merged in batches, so adding one doesn't rewrite the whole array.
+    Anything that isn't a number is kept in a plain set on the side.
+    '''
+    def __init__(self, user_ids=()):
+        self._ids = array("Q")
+        self._recent = set()
+        self._other = set()
+        self.replace(user_ids)
+
+    def replace(self, user_ids):
+        numbers = set()
+        other = set()
+        for user_id in user_ids:
+            number = UserIdSet._number(str(user_id))
+            if number is None:
+                other.add(str(user_id))
+            else:
+                numbers.add(number)
+        self._ids = array("Q", sorted(numbers))
+        self._recent = set()
+        self._other = other
+
+    @staticmethod
+    def _number(user_id):
+        if user_id.isascii() and user_id.isdigit() and len(user_id) < 20:
+            return int(user_id)
+        return None
+
+    def add(self, user_id):
+        number = UserIdSet._number(user_id)
+        if number is None:
+            self._other.add(user_id)
+            return
+        if number in self:
+            return
+        self._recent.add(number)
+        if len(self._recent) >= USER_ID_MERGE_SIZE:
+            self._ids = array("Q", heapq.merge(self._ids, sorted(self._recent)))
+            self._recent = set()
+
+    def __contains__(self, user_id):
+        if isinstance(user_id, int):
+            number = user_id
+        else:
+            number = UserIdSet._number(user_id)
+            if number is None:
+                return user_id in self._other
+        if number in self._recent:
+            return True
+        index = bisect_left(self._ids, number)
+        return index < len(self._ids) and self._ids[index] == number
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent) + len(self._other)
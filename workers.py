@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import logging
+import time
+
+log = logging.getLogger("chatbot")
+
+COMMAND_WORKERS = 8         # commands that can run at the same time
+COMMAND_QUEUE_LIMIT = 200   # waiting commands past this drop the oldest one
+PRIORITY_QUEUE_LIMIT = 20   # same for the priority lane, which is counted on its own
+
+class Job:
+    __slots__ = ("key", "func", "args", "priority", "enqueued_at", "state")
+
+    WAITING, RUNNING, DONE, DROPPED = range(4)
+
+    def __init__(self, key, func, args, priority=False):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.state = Job.WAITING
+
+class CommandPool:
+    '''
+    Runs commands on a fixed number of workers.
+    Each user has their own queue, so one user's commands run in order while different users
+    run side by side. Past COMMAND_QUEUE_LIMIT waiting commands the oldest one is dropped.
+    Jobs submitted with priority skip every queue, that's for host and mod commands sent by the host or a mod.
+    They have their own PRIORITY_QUEUE_LIMIT and never count against, or push out, the other commands.
+
+    Jobs are a coroutine function plus its arguments, so nothing is created for a command that gets dropped.
+    '''
+    def __init__(self, workers=COMMAND_WORKERS, max_queued=COMMAND_QUEUE_LIMIT, max_priority=PRIORITY_QUEUE_LIMIT):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_priority = max_priority
+        self._user_queues = {}                  # key -> deque of jobs, present while the user has work waiting or running
+        self._runnable = collections.deque()    # keys with a waiting job and nothing running
+        self._priority = collections.deque()
+        self._arrivals = collections.deque()    # every job in submit order, for dropping the oldest
+        self._wakeup = None
+        self.queued = 0
+        self.running = 0
+
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, key, func, *args, priority=False):
+        '''
+        Queue func(*args) to run for key, usually the user id. Doesn't touch the loop.
+        '''
+        job = Job(key, func, args, priority)
+        self.submitted += 1
+        if priority:
+            if len(self._priority) >= self.max_priority:
+                dropped = self._priority.popleft()
+                dropped.state = Job.DROPPED
+                self.dropped += 1
+                log.warning(f"Priority command queue is full, dropped a command from {dropped.key}.")
+            self._priority.append(job)
+        else:
+            self.queued += 1
+            queue = self._user_queues.get(key)
+            if queue is None:
+                queue = self._user_queues[key] = collections.deque()
+                self._runnable.append(key)
+            queue.append(job)
+            self._arrivals.append(job)
+            self._shed()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _shed(self):
+        while self._arrivals and self._arrivals[0].state != Job.WAITING:
+            self._arrivals.popleft()
+        while self.queued > self.max_queued and self._arrivals:
+            job = self._arrivals.popleft()
+            if job.state != Job.WAITING:
+                continue
+            # left in its user's queue and skipped when reached
+            job.state = Job.DROPPED
+            self.queued -= 1
+            self.dropped += 1
+            log.warning(f"Command queue is full, dropped a command from {job.key} that waited {time.monotonic() - job.enqueued_at:.1f}s.")
+
+    def _next(self):
+        if self._priority:
+            return self._priority.popleft()
+        while self._runnable:
+            key = self._runnable.popleft()
+            queue = self._user_queues[key]
+            while queue and queue[0].state == Job.DROPPED:
+                queue.popleft()
+            if queue:
+                return queue[0]
+            del self._user_queues[key]
+        return None
+
+    def _finish(self, job):
+        queue = self._user_queues.get(job.key)
+        if queue is None or not queue or queue[0] is not job:
+            return
+        queue.popleft()
+        while queue and queue[0].state == Job.DROPPED:
+            queue.popleft()
+        if queue:
+            self._runnable.append(job.key)
+        else:
+            del self._user_queues[job.key]
+
+    async def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            job.state = Job.RUNNING
+            if not job.priority:
+                self.queued -= 1
+            self.running += 1
+            wait = time.monotonic() - job.enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                await job.func(*job.args)
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception(f"A command from {job.key} failed in the worker pool.")
+            finally:
+                job.state = Job.DONE
+                self.running -= 1
+                self.completed += 1
+                self._finish(job)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    def stats(self):
+        started = self.completed + self.running
+        return {
+            "queued": self.queued,
+            "priority_queued": len(self._priority),
+            "running": self.running,
+            "users_waiting": len(self._user_queues),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "avg_wait": self.total_wait / started if started else 0.0,
+            "max_wait": self.max_wait
+        }